@@ -0,0 +1,60 @@
+# bucket_sampler.py
+#
+# COMS 4995 - Final Project
+# NOTE: Batches spectrograms of equal padded shape together, so train_text_to_image.py can train on the native
+# 128 x ~646 spectrogram geometry (--native_resolution) instead of resizing everything to a square
+import math
+import numpy as np
+import torch.nn.functional as F
+from torch.utils.data import Sampler
+
+
+# Rounds an image size (height, width) up to the next multiple, e.g. 64 so the latents stay divisible by 8
+def bucket_shape(size, multiple=64):
+    return tuple(int(math.ceil(length / multiple) * multiple) for length in size)
+
+
+# Pads a (channels, height, width) tensor on the bottom and right to its bucket shape
+# The value -1 is black after normalization, which is silence in a spectrogram
+def pad_to_bucket(pixel_values, multiple=64, value=-1.0):
+    height, width = bucket_shape(pixel_values.shape[-2:], multiple)
+    return F.pad(pixel_values, (0, width - pixel_values.shape[-1], 0, height - pixel_values.shape[-2]), value=value)
+
+
+# Yields batches of dataset indices that all share one bucket shape
+# Every batch is full (small buckets repeat samples) and the number of batches is a multiple of num_replicas, so
+# accelerate's per-process batch sharding never has to top up a batch with samples of another shape
+# Batches are reshuffled every epoch from seed + epoch
+class BucketBatchSampler(Sampler):
+    def __init__(self, shapes, batch_size, shuffle=True, seed=0, num_replicas=1):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.drop_last = False
+        self.epoch = 0
+        self.buckets = {}
+        for idx, shape in enumerate(shapes):
+            self.buckets.setdefault(tuple(shape), []).append(idx)
+
+    def __len__(self):
+        number_batches = sum(math.ceil(len(indices) / self.batch_size) for indices in self.buckets.values())
+        return number_batches - number_batches % self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+
+        batches = []
+        for indices in self.buckets.values():
+            indices = rng.permutation(indices) if self.shuffle else np.asarray(indices)
+            number_batches = math.ceil(len(indices) / self.batch_size)
+            indices = np.resize(indices, number_batches * self.batch_size)
+            batches.extend(indices.reshape(number_batches, self.batch_size).tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches[:len(self)])
+
+    # Number of samples in every bucket, keyed by (height, width)
+    def bucket_sizes(self):
+        return {shape: len(indices) for shape, indices in self.buckets.items()}
@@ -0,0 +1,127 @@
+# checkpoint_writer.py
+#
+# COMS 4995 - Final Project
+# NOTE: Writes the training checkpoints of train_text_to_image.py in the background. The training state is copied
+# into pinned host memory, training continues, and a separate thread writes the files in the layout that
+# accelerator.load_state (with the script's load_model_hook) reads back for --resume_from_checkpoint
+import os
+import copy
+import json
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+# Collects the files accelerator.save_state writes for a single UNet model, optimizer and learning rate scheduler
+# when the script's save_model_hook saves the models: unet/ and unet_ema/ in the diffusers format, optimizer.bin,
+# scheduler.bin, scaler.pt with fp16 mixed precision and random_states_0.pkl
+def accelerate_checkpoint_files(accelerator, unet, optimizer, lr_scheduler, ema_unet=None):
+    unet = accelerator.unwrap_model(unet)
+    files = {
+        "unet/config.json": json.loads(unet.to_json_string()),
+        "unet/diffusion_pytorch_model.bin": unet.state_dict(),
+        "optimizer.bin": optimizer.state_dict(),
+        "scheduler.bin": lr_scheduler.state_dict(),
+        "random_states_0.pkl": random_states(),
+    }
+    if ema_unet is not None:
+        # EMAModel.save_pretrained stores the EMA settings in the UNet config and the shadow weights as the UNet's
+        ema_state = ema_unet.state_dict()
+        shadow_params = ema_state.pop("shadow_params")
+        files["unet_ema/config.json"] = dict(files["unet/config.json"], **ema_state)
+        names = [name for name, _ in unet.named_parameters()]
+        files["unet_ema/diffusion_pytorch_model.bin"] = dict(zip(names, shadow_params))
+    if accelerator.scaler is not None:
+        files["scaler.pt"] = accelerator.scaler.state_dict()
+    return files
+
+
+# The random number generator states in the format accelerate saves them
+def random_states():
+    states = {
+        "random_state": random.getstate(),
+        "numpy_random_seed": np.random.get_state(),
+        "torch_manual_seed": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+# Saves checkpoints on a background thread, one at a time
+# save() only returns once every tensor is copied to host memory, so training can change the weights right after;
+# the pinned buffers are reused by the next checkpoint, which waits for the previous write to finish first
+# Files are written to tmp-<name> and renamed when complete, so a crash never leaves a partial checkpoint-<step>
+# that --resume_from_checkpoint latest would pick up; only the newest total_limit checkpoints are kept
+class AsyncCheckpointWriter:
+    def __init__(self, output_dir, total_limit=None):
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+
+    def save(self, save_path, files):
+        self.wait()
+        state = {name: self.snapshot(obj, (name,)) for name, obj in files.items()}
+        if self.pin_memory:
+            # the copies into pinned memory are asynchronous
+            torch.cuda.synchronize()
+        self.thread = threading.Thread(target=self.write, args=(save_path, state))
+        self.thread.start()
+
+    # Blocks until the checkpoint being written is on disk and raises the error of a failed write
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # Copies every tensor in a nested state dict into a host buffer kept for the same key
+    def snapshot(self, obj, key):
+        if torch.is_tensor(obj):
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory)
+                self.buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=self.pin_memory)
+            return buffer
+        if isinstance(obj, dict):
+            return type(obj)((k, self.snapshot(v, key + (k,))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def write(self, save_path, state):
+        try:
+            temp_path = os.path.join(os.path.dirname(save_path), "tmp-" + os.path.basename(save_path))
+            shutil.rmtree(temp_path, ignore_errors=True)
+            for name, obj in state.items():
+                path = os.path.join(temp_path, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if name.endswith(".json"):
+                    with open(path, "w") as f:
+                        json.dump(obj, f, indent=2, sort_keys=True)
+                else:
+                    torch.save(obj, path)
+            shutil.rmtree(save_path, ignore_errors=True)
+            os.replace(temp_path, save_path)
+            print("Saved state to " + save_path)
+            self.rotate()
+        except Exception as e:
+            self.error = e
+
+    # Deletes the oldest checkpoint-<step> folders beyond total_limit
+    def rotate(self):
+        if self.total_limit is None:
+            return
+        checkpoints = [d for d in os.listdir(self.output_dir) if d.startswith("checkpoint-")]
+        checkpoints = sorted(checkpoints, key=lambda d: int(d.split("-")[1]))
+        for name in checkpoints[:max(len(checkpoints) - self.total_limit, 0)]:
+            shutil.rmtree(os.path.join(self.output_dir, name), ignore_errors=True)
+            print("Removed old checkpoint " + name)
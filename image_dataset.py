@@ -1,21 +1,33 @@
 from bs4 import BeautifulSoup
 import os
 import json
+import http.client
+import io
+import queue
+import threading
+import time
 import urllib.request, urllib.error, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from PIL import Image
 import torch
 from torchvision import transforms
 from torch.utils.data import Dataset
-import itertools
-import glob
+from image_dedup import PerceptualIndex, phash
 
 class ImageDataSet(Dataset):
-    def __init__(self, data_dir, label_names, transforms=None):
+    def __init__(self, data_dir, label_names, transforms=None, download_workers=16,
+                 search_url="http://www.bing.com/images/search", max_resolution=None, dedup_threshold=6,
+                 cache_size=None):
         self.data_dir = data_dir
         self.label_names = label_names
         self.transforms = transforms
+        self.download_workers = download_workers
+        self.search_url = search_url
+        self.max_resolution = max_resolution
+        self.dedup_threshold = dedup_threshold
+        self.cache_size = cache_size
 
         self.supported_file_types = [".png", ".jpg", ".jpeg"]
         print("Supported files:", self.supported_file_types)
@@ -28,55 +40,139 @@ class ImageDataSet(Dataset):
             self.scrape_images()
             self.prune_data()
         
-        image_files, labels = self.get_image_filenames_with_labels(self.data_dir)
-        self.image_files = np.array(image_files)
-        self.labels = np.array(labels)
+        self.image_files, self.labels = self.get_image_filenames_with_labels(self.data_dir)
         self.num_images = len(self.image_files)
 
+        # optionally decode and resize every image once into a memory-mapped uint8 array
+        self.cache = None
+        if self.cache_size is not None:
+            self.cache_path, self.cache_valid = self.build_cache(self.cache_size)
+
     def __len__(self):
         return self.num_images
 
     def __getitem__(self, idx):
         try:
-            image = Image.open(self.image_files[idx]).convert('RGB')
+            image = self.load_image(idx)
             label = self.labels[idx]
             if self.transforms is not None:
                 image = self.transforms(image)
             return image, label
         except:
             return None
-        
+
+    # Returns the untransformed RGB image at idx, sliced from the cache if there is one
+    def load_image(self, idx):
+        if self.cache_size is None:
+            return Image.open(self.image_files[idx]).convert('RGB')
+        if not self.cache_valid[idx]:
+            raise ValueError("Image " + str(self.image_files[idx]) + " could not be decoded")
+        # opened lazily so every DataLoader worker maps the file itself
+        if self.cache is None:
+            self.cache = np.load(self.cache_path, mmap_mode='r')
+        return Image.fromarray(np.array(self.cache[idx]))
+
+    # Decodes every image once, resizes it to size x size RGB and stores the result as one (N, size, size, 3)
+    # uint8 .npy next to the data directory; like the file index, the cache is reused as long as the indexed files
+    # and the class directory mtimes are unchanged, so no image file is stat'ed
+    # An image rewritten in place under the same name leaves its directory mtime alone and keeps its stale cache
+    # entry; delete the <data_dir>_cache_<size>.json key file to force a rebuild
+    def build_cache(self, size):
+        cache_path = self.data_dir.rstrip('/') + '_cache_' + str(size) + '.npy'
+        key_path = cache_path[:-len('.npy')] + '.json'
+        dir_names, dir_mtimes = self.label_dir_mtimes(self.data_dir)
+        key = {"size": size, "files": [str(f) for f in self.image_files],
+               "dir_names": dir_names.tolist(), "dir_mtimes": dir_mtimes.tolist()}
+
+        if os.path.exists(cache_path) and os.path.exists(key_path):
+            with open(key_path) as f:
+                stored = json.load(f)
+            if all(stored.get(k) == key[k] for k in key):
+                return cache_path, np.array(stored["valid"], dtype=bool)
+
+        print("Building image cache...")
+        temp_path = cache_path[:-len('.npy')] + '.tmp.npy'
+        cache = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8,
+                                          shape=(self.num_images, size, size, 3))
+
+        def load(idx):
+            try:
+                image = Image.open(self.image_files[idx]).convert('RGB')
+                cache[idx] = np.asarray(image.resize((size, size), Image.BILINEAR))
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            valid = list(executor.map(load, range(self.num_images)))
+        cache.flush()
+        os.replace(temp_path, cache_path)
+
+        key["valid"] = valid
+        with open(key_path, 'w') as f:
+            json.dump(key, f)
+        print("Cached", sum(valid), "images at", str(size) + "x" + str(size))
+        return cache_path, np.array(valid, dtype=bool)
+
+    # Builds the file/label index with one os.scandir pass over the class directories and stores it next to
+    # the data as a .npz together with the directory mtimes; the stored index is reused while they are unchanged
     def get_image_filenames_with_labels(self, images_dir):
+        index_path = images_dir.rstrip('/') + '_index.npz'
+        dir_names, dir_mtimes = self.label_dir_mtimes(images_dir)
+
+        if os.path.exists(index_path):
+            with np.load(index_path, allow_pickle=False) as index:
+                if np.array_equal(index["dir_names"], dir_names) and np.array_equal(index["dir_mtimes"], dir_mtimes):
+                    return index["image_files"], index["labels"]
+
         image_files = []
         labels = []
-        
-        files = os.listdir(images_dir)
-        for name in files:
-            if name == ".DS_Store":
-                continue
+        for name in dir_names:
             image_class_dir = os.path.join(images_dir, name)
-            image_class_files = list(itertools.chain.from_iterable(
-                [glob.glob(image_class_dir + '/*' + file_type) for file_type in self.supported_file_types]))
+            image_class_files = sorted(
+                entry.path for entry in os.scandir(image_class_dir)
+                if entry.is_file() and os.path.splitext(entry.name)[1] in self.supported_file_types)
             image_files += image_class_files
             labels += [int(name)] * len(image_class_files)
+
+        # fixed-width unicode array instead of Python string objects
+        image_files = np.array(image_files, dtype=str)
+        labels = np.array(labels, dtype=np.int64)
+        temp_path = index_path[:-len('.npz')] + '.tmp.npz'
+        np.savez(temp_path, image_files=image_files, labels=labels, dir_names=dir_names, dir_mtimes=dir_mtimes)
+        os.replace(temp_path, index_path)
         return image_files, labels
-    
+
+    # Names and mtimes of the class directories; adding, removing or renaming an image changes its directory's mtime
+    def label_dir_mtimes(self, images_dir):
+        dir_names, dir_mtimes = [], []
+        for entry in sorted(os.scandir(images_dir), key=lambda e: e.name):
+            if entry.name == ".DS_Store" or not entry.is_dir():
+                continue
+            dir_names.append(entry.name)
+            dir_mtimes.append(entry.stat().st_mtime_ns)
+        return np.array(dir_names, dtype=str), np.array(dir_mtimes, dtype=np.int64)
+
     def print_label_dist(self):
         return np.unique(self.labels, return_counts=True)
         
     def prune_data(self):
         print("pruning data")
-        # remove failed downloads
+        # remove failed downloads and files that do not decode as images
         for label_file in os.listdir(self.data_dir):
             for filename in os.listdir(self.data_dir + label_file + '/'):
+                path = self.data_dir + label_file + '/' + filename
                 ext = os.path.splitext(filename)[1]
-                if ext not in self.supported_file_types:
-                    os.remove(self.data_dir + label_file + '/' + filename)
+                if ext not in self.supported_file_types or not is_valid_image(path):
+                    os.remove(path)
 
     def scrape_images(self):
         print("Scraping images...")
         seen_images = set()
         label_count = 0
+        pool = HostConnectionPool()
+        # catches the same picture served under a different name or size, across all labels
+        perceptual_index = PerceptualIndex(self.dedup_threshold) if self.dedup_threshold is not None else None
         for i, label in enumerate(self.label_names):
             print("===> Extracting '" + label + "' images...")
 
@@ -85,11 +181,12 @@ class ImageDataSet(Dataset):
             label = '+'.join(label)
 
             # set up the bing query using the label name as the search query
-            search_url = "http://www.bing.com/images/search?q=" + label + "&FORM=HDRSC2"
+            search_url = self.search_url + "?q=" + label + "&FORM=HDRSC2"
             header = {'User-Agent':"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/43.0.2357.134 Safari/537.36"}
-            soup = BeautifulSoup(urllib.request.urlopen(urllib.request.Request(search_url,headers=header)), 'html.parser')
+            soup = BeautifulSoup(fetch_with_retries(pool, search_url, headers=header), 'html.parser')
 
             # extract the image files from the bing search results
+            candidates = []
             for a_tag in soup.find_all("a",{"class":"iusc"}): # potentially want to manually limit how many images per class
                 try:
                     m = json.loads(a_tag["m"])
@@ -110,29 +207,263 @@ class ImageDataSet(Dataset):
                 if not os.path.exists(label_dir):
                     os.mkdir(label_dir)
 
-                # attempt to extract and download the file
-                try:
-                    img = urllib.request.urlopen(turl).read()
+                candidates.append((image_name, turl))
+
+            # download and validate the whole page concurrently, then write the files in result order so the
+            # numbering matches a sequential scrape
+            images = download_images(pool, [turl for _, turl in candidates], max_workers=self.download_workers,
+                                     process=self.ingest_image)
+            for (image_name, turl), result in zip(candidates, images):
+                if result is None:
+                    # if the image fails to download or is not a valid image, skip it
+                    print("Image: ", image_name, "failed to download or is not a valid image!")
+                    continue
+                img, image_hash = result
 
-                    # NOTE: line 112 sometimes fails to find an extension but this is handled in 
-                    # get_image_filenames_with_labels by giving valid file extensions
-                    ext = os.path.splitext(image_name)[1] 
-                    if ext not in self.supported_file_types:
+                # remove near duplicates of images that were already saved
+                if perceptual_index is not None:
+                    original = perceptual_index.add_if_new(image_hash, image_name)
+                    if original is not None:
+                        print("Image: ", image_name, "is a near duplicate of", original)
                         continue
 
-                    # rename the image to be more generic for better data organization
-                    name = label_dir + '/' + str(i) + '_' + str(label_count) + ext
-                    file = open(name, 'wb')
-                    file.write(img)
-                    file.close()
+                # every image is re-encoded as RGB JPEG at ingest, so the extension is always .jpg
+                name = self.data_dir + str(i) + '/' + str(i) + '_' + str(label_count) + '.jpg'
+                file = open(name, 'wb')
+                file.write(img)
+                file.close()
 
-                    label_count += 1
-                except Exception as e:
-                    # if the image fails to download, skip it
-                    print("Image: ", image_name, "failed to download!")
-                    continue
+                label_count += 1
+        pool.close()
         print("Finished scraping images!")
 
+    # Runs on the download threads: validates and re-encodes the image and computes its perceptual hash
+    def ingest_image(self, data):
+        img = normalize_image(data, self.max_resolution)
+        if img is None:
+            return None
+        return img, phash(Image.open(io.BytesIO(img)))
+
+
+# Keeps open HTTP(S) connections per host so downloads from the same thumbnail server reuse them
+# At most max_per_host requests run against one host at a time
+class HostConnectionPool:
+    def __init__(self, max_per_host=8, timeout=10):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def get(self, url, headers=None, max_redirects=5):
+        for _ in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            with self.host_slot(key):
+                conn = self.acquire(key)
+                try:
+                    conn.request("GET", path, headers=headers or {})
+                    response = conn.getresponse()
+                    body = response.read()
+                except Exception:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.idle[key].put(conn)
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status != 200:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return body
+        raise urllib.error.URLError("too many redirects: " + url)
+
+    def host_slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+                self.idle[key] = queue.LifoQueue()
+            return self.slots[key]
+
+    def acquire(self, key):
+        try:
+            return self.idle[key].get_nowait()
+        except queue.Empty:
+            scheme, netloc = key
+            conn_cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            return conn_cls(netloc, timeout=self.timeout)
+
+    def close(self):
+        for connections in self.idle.values():
+            while not connections.empty():
+                connections.get_nowait().close()
+
+
+# Fetches a URL through the pool, retrying connection errors, timeouts, 429 and 5xx responses with
+# exponential backoff
+def fetch_with_retries(pool, url, headers=None, retries=3, backoff=0.5):
+    for attempt in range(retries + 1):
+        try:
+            return pool.get(url, headers=headers)
+        except urllib.error.HTTPError as e:
+            if e.code != 429 and e.code < 500 or attempt == retries:
+                raise
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+# Downloads all URLs on a bounded thread pool; returns the bytes of each URL in order, or None if it failed
+# process, if given, runs on the worker thread and its result replaces the bytes (None rejects the image)
+def download_images(pool, urls, max_workers=16, retries=3, backoff=0.5, process=None):
+    def download(url):
+        try:
+            data = fetch_with_retries(pool, url, retries=retries, backoff=backoff)
+        except Exception:
+            return None
+        return process(data) if process is not None else data
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        return list(executor.map(download, urls))
+
+
+# Decodes and verifies downloaded image bytes, converts them to RGB, optionally shrinks them so the longer side
+# is at most max_resolution and re-encodes them as JPEG; returns None for anything that is not a valid image
+def normalize_image(data, max_resolution=None, quality=95):
+    try:
+        Image.open(io.BytesIO(data)).verify()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        image = image.convert('RGB')
+    except Exception:
+        return None
+    if image.width < 1 or image.height < 1:
+        return None
+    if max_resolution is not None:
+        image.thumbnail((max_resolution, max_resolution), Image.BICUBIC)
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+# True if the file on disk fully decodes as an image
+def is_valid_image(path):
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        with Image.open(path) as image:
+            image.load()
+        return True
+    except Exception:
+        return False
+
+
+# Part of an ImageDataSet with its own transforms, so training and evaluation can use different ones
+# With augment=True samples are (image, label, True) so BatchAugmentCollate augments them
+class ImageDataSubset(Dataset):
+    def __init__(self, dataset, indices, transforms=None, augment=False):
+        self.dataset = dataset
+        self.indices = list(indices)
+        self.transforms = transforms
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        try:
+            image = self.dataset.load_image(self.indices[idx])
+            label = self.dataset.labels[self.indices[idx]]
+            if self.transforms is not None:
+                image = self.transforms(image)
+            if self.augment:
+                return image, label, True
+            return image, label
+        except:
+            return None
+
+
+# Randomly splits an ImageDataSet into a training and an evaluation subset
+# augment_train marks the training samples for batched augmentation in BatchAugmentCollate
+def split_dataset(dataset, train_fraction, train_transforms=None, eval_transforms=None, seed=0,
+                  augment_train=False):
+    order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+    train_size = int(train_fraction * len(dataset))
+    return (ImageDataSubset(dataset, order[:train_size], train_transforms, augment=augment_train),
+            ImageDataSubset(dataset, order[train_size:], eval_transforms))
+
+
+# Normalization used by ViTFeatureExtractor for google/vit-base-patch16-224-in21k
+VIT_MEAN = [0.5, 0.5, 0.5]
+VIT_STD = [0.5, 0.5, 0.5]
+
+
+# Per-sample transform for BatchAugmentCollate: only converts the image to a uint8 tensor of the model size
+def uint8_transforms(size=224):
+    return transforms.Compose([transforms.PILToTensor(), transforms.Resize((size, size), antialias=True)])
+
+
+# Collate function that stacks uint8 image tensors, runs the augmentations of the notebook (sharpness,
+# autocontrast, horizontal flip) on the whole batch at once and ends in ViT-normalized pixel_values
+# Samples are (image, label) or (image, label, augment); samples without the flag use the augment default,
+# so one collate function can serve both the train and the eval split of a Trainer
+class BatchAugmentCollate:
+    def __init__(self, sharpness_factor=1.2, sharpness_p=0.2, autocontrast_p=0.2, flip_p=0.25, augment=False,
+                 mean=VIT_MEAN, std=VIT_STD):
+        self.sharpness_factor = sharpness_factor
+        self.sharpness_p = sharpness_p
+        self.autocontrast_p = autocontrast_p
+        self.flip_p = flip_p
+        self.augment = augment
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, batch):
+        batch = [b for b in batch if b is not None]
+        images = torch.stack([b[0] for b in batch])
+        labels = torch.as_tensor([int(b[1]) for b in batch], dtype=torch.long)
+        augment = torch.tensor([bool(b[2]) if len(b) > 2 else self.augment for b in batch], dtype=torch.bool)
+        if augment.any():
+            images = self.augment_batch(images, augment)
+
+        pixel_values = images.float().div_(255).sub_(self.mean).div_(self.std)
+        return {'pixel_values': pixel_values, 'labels': labels}
+
+    # Applies each augmentation to a random subset of the eligible images, like the per-image Random* transforms
+    def augment_batch(self, images, augment):
+        images = images.clone()
+        mask = augment & (torch.rand(len(images)) < self.sharpness_p)
+        if mask.any():
+            images[mask] = transforms.functional.adjust_sharpness(images[mask], self.sharpness_factor)
+        mask = augment & (torch.rand(len(images)) < self.autocontrast_p)
+        if mask.any():
+            images[mask] = transforms.functional.autocontrast(images[mask])
+        mask = augment & (torch.rand(len(images)) < self.flip_p)
+        if mask.any():
+            images[mask] = images[mask].flip(-1)
+        return images
+
+
+# DataLoader with worker processes and pinned memory for subsets built with uint8_transforms
+# collate defaults to BatchAugmentCollate, which augments the samples that split_dataset marked for it
+def make_dataloader(dataset, batch_size=16, shuffle=True, num_workers=None, pin_memory=None, collate=None):
+    if collate is None:
+        collate = BatchAugmentCollate()
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                                       pin_memory=pin_memory, persistent_workers=num_workers > 0,
+                                       collate_fn=collate)
+
+
 def collate_fn(batch):
     # Filter failed images first
     batch = list(filter(lambda x: x is not None, batch))
@@ -0,0 +1,160 @@
+# image_dedup.py
+#
+# COMS 4995 - Final Project
+# NOTE: Finds near-duplicate images with 64-bit perceptual hashes (DCT hash) and a BK-tree over their Hamming
+# distance. Used by ImageDataSet.scrape_images while scraping, and run as image_dedup.py over an existing data/
+import os
+import argparse
+import functools
+import numpy as np
+from PIL import Image
+
+
+HASH_SIZE = 8
+HASH_INPUT_SIZE = 32
+
+
+# Orthonormal DCT-II matrix, so the 2-D DCT of a block X is D @ X @ D.T
+@functools.lru_cache(maxsize=None)
+def dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+# Shrinks an image to the grayscale block that the perceptual hash is computed from
+def hash_input(image):
+    image = image.convert('L').resize((HASH_INPUT_SIZE, HASH_INPUT_SIZE), Image.LANCZOS)
+    return np.asarray(image, dtype=np.float32)
+
+
+# Computes the perceptual hashes of a stack of hash_input() blocks (N, 32, 32) in one vectorized pass
+# Each hash keeps the signs of the lowest 8x8 DCT coefficients relative to their median, packed into an int
+def phash_blocks(blocks, hash_size=HASH_SIZE):
+    blocks = np.asarray(blocks, dtype=np.float32)
+    dct = dct_matrix(blocks.shape[-1]).astype(np.float32)
+    coeffs = dct @ blocks @ dct.T
+    low = coeffs[:, :hash_size, :hash_size].reshape(len(blocks), -1)
+    # the DC term only tracks overall brightness, so it is left out of the median
+    bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    packed = np.packbits(bits, axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in packed]
+
+
+# Perceptual hash of a single PIL image
+def phash(image):
+    return phash_blocks(hash_input(image)[None])[0]
+
+
+# Number of differing bits between two hashes
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+# BK-tree over Hamming distance: a query within distance d only visits children whose edge distance lies in
+# [dist - d, dist + d], so lookups touch a small part of the tree instead of every stored hash
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, item, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, item, {})
+                return
+            node = child
+
+    # Returns (distance, value, item) for every stored hash within max_distance of value
+    def search(self, value, max_distance):
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                matches.append((distance, node_value, item))
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+
+# Keeps the hashes seen so far and reports whether a new image is a near duplicate of one of them
+class PerceptualIndex:
+    def __init__(self, threshold=6):
+        self.threshold = threshold
+        self.tree = BKTree()
+
+    def __len__(self):
+        return len(self.tree)
+
+    # Returns the item of the closest stored near duplicate, or adds the hash and returns None if there is none
+    def add_if_new(self, value, item):
+        matches = self.tree.search(value, self.threshold)
+        if matches:
+            return matches[0][2]
+        self.tree.add(value, item)
+        return None
+
+
+# Finds near-duplicate images across all label folders of data_dir; the first file in sorted order is kept
+# Returns (duplicate, original) pairs and deletes the duplicates if remove is set
+def dedup_directory(data_dir, threshold=6, remove=False, batch_size=256, file_types=(".png", ".jpg", ".jpeg")):
+    paths = []
+    for label_dir in sorted(os.listdir(data_dir)):
+        label_path = os.path.join(data_dir, label_dir)
+        if not os.path.isdir(label_path):
+            continue
+        for name in sorted(os.listdir(label_path)):
+            if os.path.splitext(name)[1].lower() in file_types:
+                paths.append(os.path.join(label_path, name))
+
+    index = PerceptualIndex(threshold)
+    duplicates = []
+    for start in range(0, len(paths), batch_size):
+        batch_paths, blocks = [], []
+        for path in paths[start:start + batch_size]:
+            try:
+                with Image.open(path) as image:
+                    blocks.append(hash_input(image))
+                batch_paths.append(path)
+            except Exception:
+                print("Could not read " + path)
+        if not blocks:
+            continue
+        for path, value in zip(batch_paths, phash_blocks(np.stack(blocks))):
+            original = index.add_if_new(value, path)
+            if original is not None:
+                duplicates.append((path, original))
+
+    for duplicate, original in duplicates:
+        print(duplicate + " duplicates " + original)
+        if remove:
+            os.remove(duplicate)
+    print("Found " + str(len(duplicates)) + " near duplicates among " + str(len(paths)) + " images")
+    return duplicates
+
+
+# Runs a dedup pass over an existing data directory when image_dedup.py is run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds near-duplicate images in a scraped data directory.")
+    parser.add_argument("--data_dir", type=str, default="./data/")
+    parser.add_argument("--threshold", type=int, default=6,
+                        help="Maximum Hamming distance between 64-bit hashes that counts as a duplicate.")
+    parser.add_argument("--remove", action="store_true", help="Delete the duplicates instead of only listing them.")
+    args = parser.parse_args()
+
+    dedup_directory(args.data_dir, threshold=args.threshold, remove=args.remove)
@@ -0,0 +1,102 @@
+# latent_cache.py
+#
+# COMS 4995 - Final Project
+# NOTE: Stores the VAE latent distribution of every training spectrogram once, so train_text_to_image.py can
+# sample latents from a memory-mapped cache (--use_latent_cache) instead of running the VAE encoder every step
+import os
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+LATENT_CACHE_FILE = "latent_cache.json"
+
+
+# Encodes every batch of pixel_values from dataloader with the VAE and writes the latent distribution parameters
+# (mean and logvar stacked on the channel axis, as in diffusers' DiagonalGaussianDistribution) to a float16
+# memmap of shape (samples, variants, 2 * latent channels, height / 8, width / 8), along with the token ids
+# flip=True also stores the latents of the horizontally flipped image as a second variant
+# The metadata file of an existing cache is deleted first and written last, and the arrays are written to temporary
+# files that are renamed at the end, so an interrupted run never leaves a cache that looks complete
+def build_latent_cache(vae, dataloader, output_dir, num_samples, resolution, flip=False, model_name=None,
+                       device="cpu", dtype=torch.float32):
+    os.makedirs(output_dir, exist_ok=True)
+    meta_path = os.path.join(output_dir, LATENT_CACHE_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    variants = 2 if flip else 1
+    channels = 2 * vae.config.latent_channels
+    size = resolution // 8
+    latents_path = os.path.join(output_dir, "latents.npy")
+    latents = np.lib.format.open_memmap(latents_path + ".tmp", mode="w+", dtype=np.float16,
+                                        shape=(num_samples, variants, channels, size, size))
+    input_ids = None
+
+    offset = 0
+    with torch.no_grad():
+        for batch in dataloader:
+            pixel_values = batch["pixel_values"].to(device, dtype=dtype)
+            end = offset + len(pixel_values)
+            for variant in range(variants):
+                images = torch.flip(pixel_values, dims=[3]) if variant == 1 else pixel_values
+                parameters = vae.encode(images).latent_dist.parameters
+                latents[offset:end, variant] = parameters.float().cpu().numpy()
+            if input_ids is None:
+                input_ids = np.zeros((num_samples, batch["input_ids"].shape[1]), dtype=np.int64)
+            input_ids[offset:end] = batch["input_ids"].cpu().numpy()
+            offset = end
+            print("Encoded " + str(offset) + " of " + str(num_samples) + " samples")
+    latents.flush()
+    del latents
+    input_ids_path = os.path.join(output_dir, "input_ids.npy")
+    with open(input_ids_path + ".tmp", "wb") as f:
+        np.save(f, input_ids)
+    os.replace(latents_path + ".tmp", latents_path)
+    os.replace(input_ids_path + ".tmp", input_ids_path)
+
+    meta = {"num_samples": num_samples, "variants": variants, "resolution": resolution,
+            "scaling_factor": vae.config.scaling_factor, "model": model_name}
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_path + ".tmp", meta_path)
+    return meta
+
+
+# Reads the metadata written by build_latent_cache
+def load_latent_cache_meta(cache_dir):
+    path = os.path.join(cache_dir, LATENT_CACHE_FILE)
+    if not os.path.exists(path):
+        raise ValueError(f"{cache_dir} is not a latent cache, build it first with --precompute_latents")
+    with open(path) as f:
+        return json.load(f)
+
+
+# PyTorch dataset over a latent cache; every access picks one of the stored variants at random
+# The latents themselves are sampled from the stored distribution in the training loop, on the GPU
+class LatentCacheDataset(Dataset):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.meta = load_latent_cache_meta(cache_dir)
+        self.input_ids = np.load(os.path.join(cache_dir, "input_ids.npy"))
+        self.latents = None
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def __getitem__(self, idx):
+        # mapped on first access so every DataLoader worker opens its own view
+        if self.latents is None:
+            self.latents = np.load(os.path.join(self.cache_dir, "latents.npy"), mmap_mode="r")
+        variant = random.randrange(self.meta["variants"])
+        return {"latent_parameters": torch.from_numpy(np.array(self.latents[idx, variant])),
+                "input_ids": torch.from_numpy(self.input_ids[idx])}
+
+
+# Draws latents from a batch of stored (mean, logvar) parameters and applies the VAE scaling factor
+def sample_latents(parameters, scaling_factor):
+    mean, logvar = torch.chunk(parameters, 2, dim=1)
+    logvar = torch.clamp(logvar, -30.0, 20.0)
+    return (mean + torch.exp(0.5 * logvar) * torch.randn_like(mean)) * scaling_factor
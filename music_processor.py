@@ -3,51 +3,170 @@
 # COMS 4995 - Final Project
 # NOTE: The system is used by running music_processor.py
 import os
+import argparse
+import contextlib
+import functools
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 import librosa
 import soundfile as sf
 import noisereduce as nr
 import numpy as np
-import random
 import matplotlib.pyplot as plt
 from PIL import Image
 import csv
+from spectrogram_inversion import invert_spectrograms
 
 
 # Called when music_processor.py is run
-def process_file(file_path, label):
+# store selects "jpeg" images, lossless "npy" spectrograms (see save_spectrogram) or "both"
+def process_file(file_path, label, batched=True, streaming=False, store="jpeg"):
     train, test, data = "train/", "test/", "data/"
 
     # Load file and separate into 15 second parts
-    segments = []
+    if streaming:
+        segments, sr = load_segments(file_path)
+    else:
+        y, sr = librosa.load(file_path)
+        segments = split_segments(y, sr)
 
-    y, sr = librosa.load(file_path)
-    segment_seconds = 15
-    segment_length = sr * segment_seconds
-    number_sections = int(np.ceil(len(y)/segment_length))
+    # Converts audio segments to spectrograms
+    if batched:
+        specs = batch_melspectrogram(segments, sr)
+    else:
+        specs = [librosa.feature.melspectrogram(y=segment, sr=sr) for segment in segments]
 
-    for i in range(min(number_sections, 15)):
-        s = y[int((number_sections/15)*i) * segment_length:(int((number_sections/15)*i)+1) * segment_length]
-        segments.append(s)
+    # Picks the test segment from the file name so the split does not depend on run or scheduling order
+    filename = file_path.split("/")[-1].split(".")[0]
+    test_idx = test_index(filename)
 
+    outputs = []
     index = 0
-    test_idx = random.randint(0, 14)
-    for segment in segments:
-        # Converts audio segment to spectrogram
-        spec = librosa.feature.melspectrogram(y=segment, sr=sr)
-
+    for spec in specs:
         # Uncomment to visualize:
         # visualize_spectrogram(spec)
 
         # Saves spectrogram image to data folder
-        spec = Image.fromarray(spec).convert("L")
-        filename = file_path.split("/")[-1].split(".")[0]
         if index == test_idx or index == test_idx - 14:
-            spec.save(data + test + "/" + filename + "-" + str(index) + ".jpeg")
+            output = os.path.join(data, test, filename + "-" + str(index))
         else:
-            spec.save(data + train + "/" + filename + "-" + str(index) + ".jpeg")
+            output = os.path.join(data, train, filename + "-" + str(index))
+        if store in ("jpeg", "both"):
+            Image.fromarray(spec).convert("L").save(output + ".jpeg")
+            outputs.append(output + ".jpeg")
+        if store in ("npy", "both"):
+            save_spectrogram(spec, output + ".npy")
+            outputs.append(output + ".npy")
 
         index += 1
 
+    return outputs
+
+
+# Returns the indices of the 15 second sections kept from a track that is number_sections long
+def segment_windows(number_sections):
+    return [int((number_sections/15)*i) for i in range(min(number_sections, 15))]
+
+
+# Cuts the track into at most 15 segments of 15 seconds spread evenly over its length
+def split_segments(y, sr):
+    segments = []
+    segment_seconds = 15
+    segment_length = sr * segment_seconds
+    number_sections = int(np.ceil(len(y)/segment_length))
+
+    for section in segment_windows(number_sections):
+        s = y[section * segment_length:(section+1) * segment_length]
+        segments.append(s)
+    return segments
+
+
+# Same segments as split_segments(), but only the kept windows are decoded with offset/duration reads,
+# so memory use depends on the segment size rather than the length of the track
+def load_segments(file_path, sr=22050):
+    segments = []
+    segment_seconds = 15
+    number_samples = int(np.ceil(librosa.get_duration(path=file_path) * sr))
+    number_sections = int(np.ceil(number_samples/(sr * segment_seconds)))
+
+    for section in segment_windows(number_sections):
+        s, _ = librosa.load(file_path, sr=sr, offset=section * segment_seconds, duration=segment_seconds)
+        segments.append(s)
+    return segments, sr
+
+
+# Builds the mel filterbank once per process and reuses it for every segment
+@functools.lru_cache(maxsize=None)
+def mel_basis(sr, n_fft=2048, n_mels=128):
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+
+
+# Computes the same power mel spectrograms as librosa.feature.melspectrogram, but stacks the segments of
+# equal length into one 2-D array so they share a single STFT and mel projection
+def batch_melspectrogram(segments, sr, n_fft=2048, hop_length=512):
+    groups = {}
+    for i, segment in enumerate(segments):
+        groups.setdefault(len(segment), []).append(i)
+
+    specs = [None] * len(segments)
+    basis = mel_basis(sr, n_fft)
+    for indices in groups.values():
+        stack = np.stack([segments[i] for i in indices])
+        power = np.abs(librosa.stft(stack, n_fft=n_fft, hop_length=hop_length)) ** 2
+        mel = np.einsum("...ft,mf->...mt", power, basis, optimize=True)
+        for j, i in enumerate(indices):
+            specs[i] = mel[j]
+    return specs
+
+
+# Maps a file name to a stable segment index in [0, 14] used for the test split
+def test_index(filename):
+    return int(hashlib.md5(filename.encode("utf-8")).hexdigest(), 16) % 15
+
+
+# Shared normalization of the lossless store: log10 power values in [log_min, log_max] are mapped onto the
+# full uint16 range, which keeps a relative error below 0.05% over 18 decades of dynamic range
+SPEC_NORM = {"encoding": "log10-uint16", "log_min": -10.0, "log_max": 8.0}
+SPEC_NORM_FILE = "spec_norm.json"
+
+
+# Saves a power mel spectrogram as log-scaled uint16 .npy and writes the normalization header next to it
+def save_spectrogram(spec, path):
+    header_path = os.path.join(os.path.dirname(path), SPEC_NORM_FILE)
+    if not os.path.exists(header_path):
+        temp_path = header_path + "." + str(os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(SPEC_NORM, f)
+        os.replace(temp_path, header_path)
+    np.save(path, encode_spectrogram(spec, SPEC_NORM))
+
+
+# Loads a spectrogram saved by process_file: .npy files are memory-mapped and decoded back to power values,
+# anything else is read as a grayscale image like before
+def load_spectrogram(path):
+    if path.endswith(".npy"):
+        with open(os.path.join(os.path.dirname(path), SPEC_NORM_FILE)) as f:
+            norm = json.load(f)
+        return decode_spectrogram(np.load(path, mmap_mode="r"), norm)
+    return np.array(Image.open(path).convert('F'))
+
+
+# Maps power values to uint16 codes on a log10 scale
+def encode_spectrogram(spec, norm):
+    log_min, log_max = norm["log_min"], norm["log_max"]
+    log_spec = np.log10(np.maximum(spec, 10.0 ** log_min))
+    codes = np.round((log_spec - log_min) / (log_max - log_min) * 65535)
+    return np.clip(codes, 0, 65535).astype(np.uint16)
+
+
+# Inverse of encode_spectrogram()
+def decode_spectrogram(codes, norm):
+    log_min, log_max = norm["log_min"], norm["log_max"]
+    log_spec = codes.astype(np.float32) / 65535 * (log_max - log_min) + log_min
+    return np.power(10.0, log_spec, dtype=np.float32)
+
 
 # Displays visualization of spectrogram, if needed
 def visualize_spectrogram(spec):
@@ -59,21 +178,143 @@ def visualize_spectrogram(spec):
 
 
 # Takes numpy array from saved image of spectrogram, converts back to audio file and saves to results folder
-def convert_to_audio(spec, label):
-    audio = librosa.feature.inverse.mel_to_audio(spec)
+# quality trades speed for fidelity, see spectrogram_inversion.QUALITY_ITERATIONS
+def convert_to_audio(spec, label, quality="balanced", output_dir="results"):
+    audio = invert_spectrograms([spec], quality=quality)[0]
     reduced_noise = nr.reduce_noise(y=audio, sr=22050, prop_decrease=.9)
-    sf.write('results/' + label + '.wav', reduced_noise, 22050)
+    sf.write(os.path.join(output_dir, label + '.wav'), reduced_noise, 22050)
 
 
 # Takes the audio files scraped from YouTube by label and calls process_file() to convert to spectrograms
-def transform_music(labels):
+# With num_workers > 1 the files are spread over a process pool; output names and the train/test split
+# only depend on the file names, so the result is the same as a serial run
+# Files whose contents and processing parameters match the manifest are skipped, and outputs of files that
+# changed or disappeared are removed; rebuild=True converts every file again
+def transform_music(labels, num_workers=1, streaming=False, store="jpeg", manifest_path="data/manifest.json",
+                    rebuild=False):
+    convert = functools.partial(process_file, streaming=streaming, store=store)
+    params = processing_params(streaming=streaming, store=store)
+    manifest = load_manifest(manifest_path)
+
+    sources = {}
+    paths, path_labels = [], []
     for label in labels:
         folder_name = label.replace(" ", "_")
-        print("Starting: " + folder_name)
         music_files = list(sorted(os.listdir(folder_name)))
         for music_file in music_files:
-            process_file(os.path.join(folder_name, music_file), label)
-        print("Finished: " + folder_name)
+            file_path = os.path.join(folder_name, music_file)
+            entry = manifest.get(file_path)
+            source = source_entry(file_path, entry)
+            source["params"] = params
+            if not rebuild and entry_is_current(entry, source):
+                source["outputs"] = entry["outputs"]
+            else:
+                paths.append(file_path)
+                path_labels.append(label)
+            sources[file_path] = source
+
+    # Keeps entries of other labels and drops the outputs of anything that is rebuilt or no longer exists
+    entries = {}
+    for file_path, entry in manifest.items():
+        if file_path in sources:
+            if "outputs" in sources[file_path]:
+                entries[file_path] = sources[file_path]
+            else:
+                remove_outputs(entry["outputs"])
+        elif os.path.exists(file_path):
+            entries[file_path] = entry
+        else:
+            remove_outputs(entry["outputs"])
+    print("Skipping " + str(len(sources) - len(paths)) + " unchanged files, converting " + str(len(paths)))
+
+    start = time.perf_counter()
+    number_segments = 0
+    with ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else contextlib.nullcontext() as executor:
+        if executor is None:
+            results = map(convert, paths, path_labels)
+        else:
+            results = executor.map(convert, paths, path_labels, chunksize=4)
+
+        current_label = None
+        for file_path, label, outputs in zip(paths, path_labels, results):
+            if label != current_label:
+                print("Starting: " + label.replace(" ", "_"))
+                current_label = label
+            entries[file_path] = dict(sources[file_path], outputs=outputs)
+            save_manifest(manifest_path, entries)
+            number_segments += count_segments(outputs)
+    save_manifest(manifest_path, entries)
+
+    report_throughput(len(paths), number_segments, time.perf_counter() - start)
+
+
+# Settings that change the generated spectrograms; a change to any of them invalidates the manifest
+def processing_params(streaming=False, store="jpeg"):
+    params = {"sr": 22050, "segment_seconds": 15, "max_segments": 15, "n_fft": 2048, "hop_length": 512,
+              "n_mels": 128, "streaming": streaming, "split": "md5-name", "format": store}
+    if store != "jpeg":
+        params["norm"] = SPEC_NORM
+    return params
+
+
+# Describes a source file for the manifest; the content hash is only recomputed when the size or mtime changed
+def source_entry(file_path, entry):
+    stat = os.stat(file_path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        digest = entry["hash"]
+    else:
+        digest = file_hash(file_path)
+    return {"hash": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+# True when a manifest entry was built from the same contents and parameters and all its outputs still exist
+def entry_is_current(entry, source):
+    return (entry is not None and entry["hash"] == source["hash"] and entry["params"] == source["params"]
+            and all(os.path.exists(output) for output in entry["outputs"]))
+
+
+# Hashes the contents of a file in 1 MB chunks
+def file_hash(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Reads the build manifest, mapping each source file to its hash, parameters and output paths
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)["files"]
+
+
+# Writes the manifest through a temporary file so an interrupted run never leaves it half written
+def save_manifest(manifest_path, entries):
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"files": entries}, f, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+# Deletes previously generated outputs that are no longer valid
+def remove_outputs(outputs):
+    for output in outputs:
+        if os.path.exists(output):
+            os.remove(output)
+
+
+# Number of segments behind a list of output paths; store="both" writes a .jpeg and a .npy for every segment
+def count_segments(outputs):
+    return len(set(os.path.splitext(output)[0] for output in outputs))
+
+
+# Prints how many files and segments were converted per second
+def report_throughput(number_files, number_segments, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    print("Processed {} files ({} segments) in {:.1f}s: {:.2f} files/sec, {:.2f} segments/sec".format(
+        number_files, number_segments, elapsed, number_files / elapsed, number_segments / elapsed))
 
 
 # Generates metadata.csv file needed to match captions to spectrograms in dataset
@@ -84,6 +325,9 @@ def create_csv(paths):
     for path in paths:
         images = list(sorted(os.listdir(path)))
         for image in images:
+            # Lossless .npy spectrograms and their header are not part of the image dataset
+            if os.path.splitext(image)[1] not in (".jpeg", ".jpg", ".png"):
+                continue
             captions.append([path.split("/")[-1] + "/" + image, " ".join(image.split("_")[:2]) + " spectrogram"])
 
     with open('data/metadata.csv', 'w', newline='') as f:
@@ -93,33 +337,43 @@ def create_csv(paths):
 
 
 # Called when music_processor.py is run
-def main():
+def main(num_workers=1, streaming=False, store="jpeg", rebuild=False):
     labels = ['dark music', 'somber music', 'gloomy music', 'sad music',
               'bright music', 'happy music', 'cheerful music',
               'techno music', 'night club music', 'party music',
               'calm music', 'peaceful music', 'relaxing music',
               'classical music', 'classic music']
 
-    transform_music(labels)
+    transform_music(labels, num_workers=num_workers, streaming=streaming, store=store, rebuild=rebuild)
 
 
 # Calls main() when music_processor.py is run
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Converts the scraped audio files into spectrogram images.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes used to build spectrograms (1 runs serially).")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Decode only the 15 second windows that are kept instead of whole tracks.")
+    parser.add_argument("--store", choices=["jpeg", "npy", "both"], default="jpeg",
+                        help="Save 8-bit JPEG images, lossless log-scaled uint16 .npy spectrograms, or both.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Convert every file again instead of only new or modified ones.")
+    args = parser.parse_args()
+
+    main(num_workers=args.workers, streaming=args.streaming, store=args.store, rebuild=args.rebuild)
     create_csv(["data/train", "data/test"])
 
     # Uncomment to visualize saved spectrogram images
     # examples = ["##INSERT-EXAMPLE-NAME-HERE##"]
 
     # for example in examples:
-    #    img = Image.open(example).convert('F')
-    #    spec = np.array(img)
+    #    spec = load_spectrogram(example)
     #    visualize_spectrogram(spec)
 
     # Uncomment to convert saved spectrogram back to audio
+    # (use render_audio.py to convert a whole folder of spectrograms in parallel)
     # examples = ["##INSERT-EXAMPLE-NAME-HERE##"]
 
     # for example in examples:
-    #    img = Image.open(example).convert('F')
-    #    spec = np.array(img)
+    #    spec = load_spectrogram(example)
     #    convert_to_audio(spec, example.split(".")[0])
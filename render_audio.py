@@ -0,0 +1,96 @@
+# render_audio.py
+#
+# COMS 4995 - Final Project
+# NOTE: Renders generated spectrograms (e.g. spectrogram_results/) to .wav files (e.g. results/) in parallel
+import os
+import argparse
+import glob
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from music_processor import load_spectrogram, convert_to_audio
+from spectrogram_inversion import QUALITY_ITERATIONS
+
+
+SPECTROGRAM_TYPES = (".png", ".jpg", ".jpeg", ".npy")
+
+
+# Expands directories and glob patterns into a sorted list of spectrogram files
+def find_spectrograms(inputs):
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for path in glob.glob(pattern):
+            if os.path.splitext(path)[1].lower() in SPECTROGRAM_TYPES:
+                paths.add(path)
+    return sorted(paths)
+
+
+# Returns the .wav file a spectrogram is rendered to
+def output_path(spec_path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(spec_path))[0] + ".wav")
+
+
+# True when the .wav file exists and is newer than its spectrogram
+def is_up_to_date(spec_path, wav_path):
+    return os.path.exists(wav_path) and os.path.getmtime(wav_path) >= os.path.getmtime(spec_path)
+
+
+# Renders one spectrogram to audio and returns how long it took in seconds
+def render(spec_path, output_dir, quality):
+    start = time.perf_counter()
+    label = os.path.splitext(os.path.basename(spec_path))[0]
+    convert_to_audio(load_spectrogram(spec_path), label, quality=quality, output_dir=output_dir)
+    return time.perf_counter() - start
+
+
+# Renders every spectrogram matched by inputs whose .wav is missing or older, using a process pool
+def render_all(inputs, output_dir="results", num_workers=1, quality="balanced", force=False):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = find_spectrograms(inputs)
+    todo = [path for path in paths if force or not is_up_to_date(path, output_path(path, output_dir))]
+    print("Rendering " + str(len(todo)) + " spectrograms, " + str(len(paths) - len(todo)) + " already up to date")
+
+    start = time.perf_counter()
+    latencies = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        futures = {executor.submit(render, path, output_dir, quality): path for path in todo}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                latency = future.result()
+            except Exception as e:
+                print("Failed: " + path + " (" + str(e) + ")")
+                failed.append(path)
+                continue
+            latencies.append(latency)
+            print("{:.2f}s  {} -> {}".format(latency, path, output_path(path, output_dir)))
+
+    elapsed = time.perf_counter() - start
+    if latencies:
+        print("Rendered {} files in {:.1f}s ({:.2f} files/sec)".format(
+            len(latencies), elapsed, len(latencies) / max(elapsed, 1e-9)))
+        print("Latency mean {:.2f}s, median {:.2f}s, max {:.2f}s".format(
+            np.mean(latencies), np.median(latencies), np.max(latencies)))
+    return latencies, failed
+
+
+# Runs when render_audio.py is run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts spectrogram images to .wav files.")
+    parser.add_argument("inputs", nargs="*", default=["spectrogram_results"],
+                        help="Directories or glob patterns of spectrograms (default: spectrogram_results).")
+    parser.add_argument("--output_dir", type=str, default="results")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--quality", choices=list(QUALITY_ITERATIONS), default="balanced")
+    parser.add_argument("--force", action="store_true", help="Render again even if the .wav file is up to date.")
+    args = parser.parse_args()
+
+    _, failed = render_all(args.inputs, output_dir=args.output_dir, num_workers=args.workers, quality=args.quality,
+                           force=args.force)
+    # a non-zero exit status lets batch jobs notice failed renders
+    if failed:
+        sys.exit(1)
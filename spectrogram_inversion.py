@@ -0,0 +1,97 @@
+# spectrogram_inversion.py
+#
+# COMS 4995 - Final Project
+# NOTE: Turns power mel spectrograms back into audio without a GPU. Used by music_processor.convert_to_audio;
+# run spectrogram_inversion.py on a few spectrograms to benchmark it against librosa's mel_to_audio
+import argparse
+import functools
+import time
+import librosa
+import numpy as np
+
+
+# Number of fast Griffin-Lim iterations for each quality setting
+QUALITY_ITERATIONS = {"draft": 8, "fast": 16, "balanced": 24, "high": 48}
+
+
+# Builds the pseudo-inverse of the mel filterbank once per process
+# librosa's mel_to_audio solves a non-negative least squares problem for every spectrogram instead
+@functools.lru_cache(maxsize=None)
+def mel_pinv(sr, n_fft=2048, n_mels=128):
+    return np.linalg.pinv(librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)).astype(np.float32)
+
+
+# Maps a stack of power mel spectrograms (..., n_mels, frames) back to linear STFT magnitudes
+def mel_to_stft(mel, sr=22050, n_fft=2048, power=2.0):
+    inverse = mel_pinv(sr, n_fft, mel.shape[-2])
+    linear = np.einsum("fm,...mt->...ft", inverse, mel, optimize=True)
+    return np.power(np.maximum(linear, 0), 1.0 / power, dtype=np.float32)
+
+
+# Inverts many mel spectrograms at once; spectrograms of the same shape share one batched fast Griffin-Lim run
+# quality picks an iteration budget from QUALITY_ITERATIONS, n_iter overrides it
+def invert_spectrograms(specs, sr=22050, quality="balanced", n_iter=None, momentum=0.99, n_fft=2048,
+                        hop_length=512):
+    if n_iter is None:
+        n_iter = QUALITY_ITERATIONS[quality]
+
+    groups = {}
+    for i, spec in enumerate(specs):
+        groups.setdefault(np.shape(spec), []).append(i)
+
+    audio = [None] * len(specs)
+    for indices in groups.values():
+        mel = np.stack([np.asarray(specs[i], dtype=np.float32) for i in indices])
+        magnitude = mel_to_stft(mel, sr=sr, n_fft=n_fft)
+        # momentum > 0 is the fast Griffin-Lim update of Perraudin et al.
+        # a fixed random state keeps renders repeatable
+        y = librosa.griffinlim(magnitude, n_iter=n_iter, hop_length=hop_length, n_fft=n_fft, momentum=momentum,
+                               random_state=0)
+        for j, i in enumerate(indices):
+            audio[i] = y[j]
+    return audio
+
+
+# Relative distance between a mel spectrogram and the mel spectrogram of the audio rebuilt from it
+def spectral_convergence(spec, audio, sr=22050):
+    rebuilt = librosa.feature.melspectrogram(y=audio, sr=sr)
+    frames = min(spec.shape[-1], rebuilt.shape[-1])
+    spec, rebuilt = np.sqrt(spec[:, :frames]), np.sqrt(rebuilt[:, :frames])
+    return float(np.linalg.norm(spec - rebuilt) / max(np.linalg.norm(spec), 1e-12))
+
+
+# Times librosa's mel_to_audio against every quality setting of invert_spectrograms on the same spectrograms
+def benchmark(specs, sr=22050, qualities=None):
+    if qualities is None:
+        qualities = list(QUALITY_ITERATIONS)
+
+    results = []
+    start = time.perf_counter()
+    reference = [librosa.feature.inverse.mel_to_audio(spec, sr=sr) for spec in specs]
+    elapsed = time.perf_counter() - start
+    results.append(("librosa mel_to_audio", elapsed, np.mean([spectral_convergence(s, a, sr)
+                                                               for s, a in zip(specs, reference)])))
+
+    for quality in qualities:
+        start = time.perf_counter()
+        audio = invert_spectrograms(specs, sr=sr, quality=quality)
+        elapsed = time.perf_counter() - start
+        results.append((quality + " (" + str(QUALITY_ITERATIONS[quality]) + " iters)", elapsed,
+                        np.mean([spectral_convergence(s, a, sr) for s, a in zip(specs, audio)])))
+
+    for name, elapsed, error in results:
+        print("{:<28} {:7.2f}s total  {:6.2f}s/clip  spectral convergence {:.4f}".format(
+            name, elapsed, elapsed / len(specs), error))
+    return results
+
+
+# Benchmarks the inversion on the given spectrograms when spectrogram_inversion.py is run
+if __name__ == "__main__":
+    from music_processor import load_spectrogram
+
+    parser = argparse.ArgumentParser(description="Benchmarks mel spectrogram inversion.")
+    parser.add_argument("spectrograms", nargs="+", help="Spectrogram images or lossless .npy files.")
+    parser.add_argument("--quality", nargs="+", choices=list(QUALITY_ITERATIONS), default=None)
+    args = parser.parse_args()
+
+    benchmark([load_spectrogram(path) for path in args.spectrograms], qualities=args.quality)
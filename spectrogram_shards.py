@@ -0,0 +1,128 @@
+# spectrogram_shards.py
+#
+# COMS 4995 - Final Project
+# NOTE: Packs the spectrogram images written by music_processor.py into a few large shard files so training
+# can memory-map them instead of indexing and decoding thousands of small JPEGs
+import os
+import argparse
+import csv
+import json
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+
+SHARDS_FILE = "shards.json"
+
+
+# Reads the file names and captions listed in metadata.csv
+def read_metadata(data_dir, caption_column="caption_column"):
+    with open(os.path.join(data_dir, "metadata.csv"), newline='') as f:
+        return [(row["file_name"], row[caption_column]) for row in csv.DictReader(f)]
+
+
+# Packs every image listed in data_dir/metadata.csv into shards of at most shard_size samples
+# Each shard is one contiguous uint8 pixel buffer plus an index of (offset, height, width, caption id) rows;
+# the caption table and, if a tokenizer is given, its token ids are stored once for the whole dataset
+def pack_shards(data_dir, output_dir, shard_size=1024, split=None, tokenizer_name=None):
+    rows = read_metadata(data_dir)
+    if split is not None:
+        rows = [row for row in rows if row[0].startswith(split + "/")]
+
+    captions = sorted(set(caption for _, caption in rows))
+    caption_ids = {caption: i for i, caption in enumerate(captions)}
+
+    os.makedirs(output_dir, exist_ok=True)
+    shards = []
+    for start in range(0, len(rows), shard_size):
+        name = "shard-{:05d}".format(len(shards))
+        images = []
+        index = np.zeros((len(rows[start:start + shard_size]), 4), dtype=np.int64)
+        offset = 0
+        for i, (file_name, caption) in enumerate(rows[start:start + shard_size]):
+            image = np.asarray(Image.open(os.path.join(data_dir, file_name)).convert("L"))
+            index[i] = [offset, image.shape[0], image.shape[1], caption_ids[caption]]
+            images.append(image.ravel())
+            offset += image.size
+
+        np.save(os.path.join(output_dir, name + ".images.npy"), np.concatenate(images))
+        np.save(os.path.join(output_dir, name + ".index.npy"), index)
+        shards.append({"name": name, "size": len(index)})
+        print("Packed " + name + " with " + str(len(index)) + " spectrograms")
+
+    meta = {"captions": captions, "shards": shards, "mode": "L"}
+    if tokenizer_name is not None:
+        from transformers import CLIPTokenizer
+
+        tokenizer = CLIPTokenizer.from_pretrained(tokenizer_name, subfolder="tokenizer")
+        input_ids = tokenizer(captions, max_length=tokenizer.model_max_length, padding="max_length",
+                              truncation=True, return_tensors="np").input_ids
+        np.save(os.path.join(output_dir, "tokens.npy"), input_ids.astype(np.int64))
+        meta["tokens"] = "tokens.npy"
+
+    with open(os.path.join(output_dir, SHARDS_FILE), "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+# PyTorch dataset over the shards written by pack_shards()
+# Shards are memory-mapped lazily so every DataLoader worker maps its own view instead of copying the data
+class ShardedSpectrogramDataset(Dataset):
+    def __init__(self, shard_dir, transforms=None):
+        self.shard_dir = shard_dir
+        self.transforms = transforms
+
+        with open(os.path.join(shard_dir, SHARDS_FILE)) as f:
+            meta = json.load(f)
+        self.captions = meta["captions"]
+        self.shard_names = [shard["name"] for shard in meta["shards"]]
+        self.ends = np.cumsum([shard["size"] for shard in meta["shards"]])
+        self.indexes = [np.load(os.path.join(shard_dir, name + ".index.npy")) for name in self.shard_names]
+        self.tokens = np.load(os.path.join(shard_dir, meta["tokens"])) if "tokens" in meta else None
+        self.images = None
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = [np.load(os.path.join(self.shard_dir, name + ".images.npy"), mmap_mode="r")
+                           for name in self.shard_names]
+
+        shard = int(np.searchsorted(self.ends, idx, side="right"))
+        row = idx - (int(self.ends[shard - 1]) if shard > 0 else 0)
+        offset, height, width, caption_id = self.indexes[shard][row]
+        pixels = self.images[shard][offset:offset + height * width].reshape(height, width)
+
+        example = {"image": Image.fromarray(np.array(pixels), mode="L"),
+                   "caption": self.captions[caption_id],
+                   "caption_id": int(caption_id)}
+        if self.tokens is not None:
+            example["input_ids"] = torch.from_numpy(self.tokens[caption_id])
+        if self.transforms is not None:
+            example = self.transforms(example)
+        return example
+
+    # Returns the (height, width) of every sample without touching the pixel data
+    def image_sizes(self):
+        return np.concatenate([index[:, 1:3] for index in self.indexes])
+
+    # Returns the caption id of every sample without touching the pixel data
+    def caption_ids(self):
+        return np.concatenate([index[:, 3] for index in self.indexes])
+
+
+# Packs data/ into shards when spectrogram_shards.py is run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packs the spectrogram dataset into memory-mappable shards.")
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--output_dir", type=str, default="data_shards")
+    parser.add_argument("--shard_size", type=int, default=1024, help="Number of spectrograms per shard.")
+    parser.add_argument("--split", type=str, default=None,
+                        help="Only pack files under this folder of data_dir (e.g. train). Packs everything if unset.")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="Pretrained model whose CLIP tokenizer is used to store token ids for the captions.")
+    args = parser.parse_args()
+
+    pack_shards(args.data_dir, args.output_dir, shard_size=args.shard_size, split=args.split,
+                tokenizer_name=args.tokenizer)
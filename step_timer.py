@@ -0,0 +1,121 @@
+# step_timer.py
+#
+# COMS 4995 - Final Project
+# NOTE: Timing instrumentation for the train_text_to_image.py loop. StepTimer measures how long every phase of a
+# training step takes (data loading, VAE, text encoder, UNet forward/backward, optimizer, EMA, checkpointing) and
+# ProfilerWindow records a torch profiler trace for a range of steps; both also work on CPU-only machines
+import os
+import contextlib
+import resource
+import time
+from collections import defaultdict
+import torch
+
+
+# Accumulates the time spent in named spans between two calls to summary()
+# On a GPU the spans are timed with CUDA events, so timing does not add synchronizations to the step; the events
+# are only read in summary(). Waiting for the dataloader is host time and is measured with perf_counter
+class StepTimer:
+    def __init__(self, device):
+        self.device = device
+        self.cuda = device.type == "cuda"
+        self.record_functions = False
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.events = []
+        self.samples = 0
+        self.start = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # shows the span in profiler traces while a ProfilerWindow is recording
+        label = torch.profiler.record_function(name) if self.record_functions else contextlib.nullcontext()
+        with label:
+            if self.cuda:
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self.events.append((name, start, end))
+            else:
+                start = time.perf_counter()
+                yield
+                self.times[name] += time.perf_counter() - start
+
+    # Yields the batches of a dataloader, adding the time spent waiting for each one to the data_wait span
+    def iterate(self, dataloader):
+        iterator = iter(dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.times["data_wait"] += time.perf_counter() - start
+            yield batch
+
+    def add_samples(self, number_samples):
+        self.samples += number_samples
+
+    # Returns the seconds spent in every span, samples/sec, the fraction of the wall time spent waiting for data and
+    # the peak memory in GB since the last summary, then starts a new interval
+    def summary(self):
+        for name, start, end in self.events:
+            end.synchronize()
+            self.times[name] += start.elapsed_time(end) / 1000.0
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+
+        metrics = {"time/" + name: seconds for name, seconds in self.times.items()}
+        metrics["time/step"] = elapsed
+        metrics["samples_per_sec"] = self.samples / elapsed
+        metrics["data_wait_fraction"] = self.times["data_wait"] / elapsed
+        if self.cuda:
+            metrics["peak_memory_gb"] = torch.cuda.max_memory_allocated(self.device) / 2**30
+        else:
+            # ru_maxrss is the peak resident size of the process in KB on Linux
+            metrics["peak_memory_gb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+        self.reset()
+        return metrics
+
+
+# Records a torch profiler trace from global step start up to (not including) global step end
+# The trace is written as a Chrome trace to output_dir/profile-<start>-<end>.json and a summary table is printed
+class ProfilerWindow:
+    def __init__(self, start, end, output_dir, timer=None):
+        self.start = start
+        self.end = end
+        self.output_dir = output_dir
+        self.timer = timer
+        self.profiler = None
+
+    # Called with the global step before every training step
+    def step(self, global_step):
+        if self.profiler is None and self.start <= global_step < self.end:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+            if self.timer is not None:
+                self.timer.record_functions = True
+        elif self.profiler is not None and global_step >= self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        if self.timer is not None:
+            self.timer.record_functions = False
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, "profile-{}-{}.json".format(self.start, self.end))
+        self.profiler.export_chrome_trace(path)
+        sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        print(self.profiler.key_averages().table(sort_by=sort_by, row_limit=25))
+        print("Saved profiler trace to " + path)
+        self.profiler = None
@@ -18,10 +18,14 @@
 # See the License for the specific language governing permissions and
 
 import argparse
+import contextlib
+import copy
+import io
 import logging
 import math
 import os
 import random
+import threading
 from pathlib import Path
 
 import accelerate
@@ -38,6 +42,7 @@ from accelerate.utils import ProjectConfiguration, set_seed
 from datasets import load_dataset
 from huggingface_hub import create_repo, upload_folder
 from packaging import version
+from PIL import Image
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
@@ -48,6 +53,11 @@ from diffusers.optimization import get_scheduler
 from diffusers.training_utils import EMAModel
 from diffusers.utils import check_min_version, deprecate, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
+from bucket_sampler import BucketBatchSampler, bucket_shape, pad_to_bucket
+from checkpoint_writer import AsyncCheckpointWriter, accelerate_checkpoint_files
+from latent_cache import LatentCacheDataset, build_latent_cache, load_latent_cache_meta, sample_latents
+from spectrogram_shards import ShardedSpectrogramDataset
+from step_timer import ProfilerWindow, StepTimer
 
 
 if is_wandb_available():
@@ -64,55 +74,135 @@ DATASET_NAME_MAPPING = {
 }
 
 
-def log_validation(vae, text_encoder, tokenizer, unet, args, accelerator, weight_dtype, epoch):
-    logger.info("Running validation... ")
-
-    pipeline = StableDiffusionPipeline.from_pretrained(
-        args.pretrained_model_name_or_path,
-        vae=accelerator.unwrap_model(vae),
-        text_encoder=accelerator.unwrap_model(text_encoder),
-        tokenizer=tokenizer,
-        unet=accelerator.unwrap_model(unet),
-        safety_checker=None,
-        revision=args.revision,
-        torch_dtype=weight_dtype,
-    )
-    pipeline = pipeline.to(accelerator.device)
-    pipeline.set_progress_bar_config(disable=True)
-
-    if args.enable_xformers_memory_efficient_attention:
-        pipeline.enable_xformers_memory_efficient_attention()
-
-    if args.seed is None:
-        generator = None
-    else:
-        generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)
-
-    images = []
-    for i in range(len(args.validation_prompts)):
-        with torch.autocast("cuda"):
-            image = pipeline(args.validation_prompts[i], num_inference_steps=20, generator=generator).images[0]
-
-        images.append(image)
-
-    for tracker in accelerator.trackers:
-        if tracker.name == "tensorboard":
-            np_images = np.stack([np.asarray(img) for img in images])
-            tracker.writer.add_images("validation", np_images, epoch, dataformats="NHWC")
-        elif tracker.name == "wandb":
-            tracker.log(
-                {
-                    "validation": [
-                        wandb.Image(image, caption=f"{i}: {args.validation_prompts[i]}")
-                        for i, image in enumerate(images)
-                    ]
-                }
+# Encodes prompts with the text encoder on device; the validation prompts are encoded before the caption cache
+# moves the text encoder to the CPU
+def encode_prompts(text_encoder, tokenizer, prompts, device):
+    input_ids = tokenizer(
+        prompts, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+    ).input_ids
+    with torch.no_grad():
+        return text_encoder(input_ids.to(device))[0]
+
+
+# StableDiffusionPipeline that always runs on the device of its UNet. DiffusionPipeline.device returns the device
+# of whichever module it finds first, which may be the text encoder parked on the CPU by the caption cache
+class ValidationPipeline(StableDiffusionPipeline):
+    @property
+    def _execution_device(self):
+        return self.unet.device
+
+
+# Runs the validation prompts through a StableDiffusionPipeline that is built once from the live training modules
+# instead of being reloaded from disk for every validation run
+# prompt_embeds holds the embeddings of the validation prompts followed by the empty prompt. All prompts run as
+# one batch with one fixed seed per prompt so the images of different runs are comparable, and with
+# run_async=True the denoising runs on a background thread with its own copy of the UNet weights, so training
+# only waits for the weights to be copied
+class ValidationHarness:
+    def __init__(self, args, accelerator, vae, text_encoder, tokenizer, unet, weight_dtype, prompt_embeds,
+                 height=None, width=None, run_async=False):
+        self.args = args
+        self.accelerator = accelerator
+        self.weight_dtype = weight_dtype
+        self.prompts = list(args.validation_prompts)
+        self.height = height
+        self.width = width
+        self.run_async = run_async
+        self.thread = None
+        self.stream = torch.cuda.Stream() if run_async and accelerator.device.type == "cuda" else None
+
+        if vae is None:
+            # Training from a latent cache never loads the VAE, so only validation holds a copy
+            vae = AutoencoderKL.from_pretrained(
+                args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision
             )
-        else:
-            logger.warn(f"image logging not implemented for {tracker.name}")
+            vae.requires_grad_(False)
+            vae.to(accelerator.device, dtype=weight_dtype)
 
-    del pipeline
-    torch.cuda.empty_cache()
+        unet = accelerator.unwrap_model(unet)
+        self.source_unet = unet
+        self.unet = unet
+        if run_async:
+            self.unet = copy.deepcopy(unet).to(accelerator.device, dtype=weight_dtype)
+            self.unet.requires_grad_(False)
+
+        model_index = StableDiffusionPipeline.load_config(args.pretrained_model_name_or_path, revision=args.revision)
+        scheduler = getattr(diffusers, model_index["scheduler"][1]).from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="scheduler", revision=args.revision
+        )
+        # The text encoder is never called since the prompts are passed as embeddings, so it may stay on the CPU
+        self.pipeline = ValidationPipeline(
+            vae=vae,
+            text_encoder=accelerator.unwrap_model(text_encoder),
+            tokenizer=tokenizer,
+            unet=self.unet,
+            scheduler=scheduler,
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+        )
+        self.pipeline.set_progress_bar_config(disable=True)
+        if args.enable_xformers_memory_efficient_attention:
+            self.pipeline.enable_xformers_memory_efficient_attention()
+
+        # Prompt and empty prompt embeddings for classifier free guidance
+        prompt_embeds = prompt_embeds.to(accelerator.device, dtype=weight_dtype)
+        self.prompt_embeds = prompt_embeds[:-1]
+        self.negative_prompt_embeds = prompt_embeds[-1:].expand_as(self.prompt_embeds)
+        self.seed = args.seed if args.seed is not None else 0
+
+    # Generates the validation images for the current UNet weights and logs them at step
+    def run(self, step):
+        self.wait()
+        if self.run_async:
+            with torch.no_grad():
+                for copy_param, param in zip(self.unet.parameters(), self.source_unet.parameters()):
+                    copy_param.copy_(param)
+            if self.stream is not None:
+                # the copies above are queued on the default stream, the background stream waits for them
+                self.stream.wait_stream(torch.cuda.current_stream())
+            self.thread = threading.Thread(target=self.generate, args=(step,), daemon=True)
+            self.thread.start()
+        else:
+            self.generate(step)
+
+    # Blocks until a running background validation is finished
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def generate(self, step):
+        logger.info("Running validation... ")
+        device = self.accelerator.device
+        generator = [torch.Generator(device=device).manual_seed(self.seed + i) for i in range(len(self.prompts))]
+        stream = torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()
+        with stream, torch.autocast(device.type, enabled=device.type == "cuda"):
+            images = self.pipeline(
+                prompt_embeds=self.prompt_embeds,
+                negative_prompt_embeds=self.negative_prompt_embeds,
+                height=self.height,
+                width=self.width,
+                num_inference_steps=20,
+                generator=generator,
+            ).images
+        self.log_images(images, step)
+
+    def log_images(self, images, step):
+        for tracker in self.accelerator.trackers:
+            if tracker.name == "tensorboard":
+                np_images = np.stack([np.asarray(img) for img in images])
+                tracker.writer.add_images("validation", np_images, step, dataformats="NHWC")
+            elif tracker.name == "wandb":
+                tracker.log(
+                    {
+                        "validation": [
+                            wandb.Image(image, caption=f"{i}: {self.prompts[i]}") for i, image in enumerate(images)
+                        ]
+                    }
+                )
+            else:
+                logger.warn(f"image logging not implemented for {tracker.name}")
 
 
 def parse_args():
@@ -157,6 +247,46 @@ def parse_args():
             " must exist to provide the captions for the images. Ignored if `dataset_name` is specified."
         ),
     )
+    parser.add_argument(
+        "--shard_dir",
+        type=str,
+        default=None,
+        help=(
+            "A folder of spectrogram shards written by `spectrogram_shards.py`. The shards are memory-mapped instead"
+            " of indexing the image folder. Takes precedence over `dataset_name` and `train_data_dir`."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help="Folder of the VAE latent cache written by `--precompute_latents` and read by `--use_latent_cache`.",
+    )
+    parser.add_argument(
+        "--precompute_latents",
+        action="store_true",
+        help=(
+            "Encode the training images once with the VAE into `--latent_cache_dir` and exit. Images are center"
+            " cropped; with `--random_flip` the flipped images are encoded as well."
+        ),
+    )
+    parser.add_argument(
+        "--use_latent_cache",
+        action="store_true",
+        help=(
+            "Train on latents sampled from `--latent_cache_dir` instead of encoding the images every step. The VAE"
+            " is not loaded for training, only by the validation pipeline."
+        ),
+    )
+    parser.add_argument(
+        "--max_cached_captions",
+        type=int,
+        default=256,
+        help=(
+            "If the dataset has at most this many distinct captions, their text embeddings are computed once and"
+            " looked up by index, and the text encoder is moved off the GPU. 0 encodes the captions every step."
+        ),
+    )
     parser.add_argument(
         "--image_column", type=str, default="image", help="The column of the dataset containing an image."
     )
@@ -218,6 +348,23 @@ def parse_args():
         action="store_true",
         help="whether to randomly flip images horizontally",
     )
+    parser.add_argument(
+        "--native_resolution",
+        action="store_true",
+        help=(
+            "Keep every image at its own size instead of resizing and cropping to `--resolution`. Images are padded"
+            " to multiples of `--bucket_multiple` and each batch only holds images of the same padded shape."
+        ),
+    )
+    parser.add_argument(
+        "--bucket_multiple",
+        type=int,
+        default=64,
+        help=(
+            "With `--native_resolution`, image sides are padded to a multiple of this. 64 keeps the latent sides"
+            " divisible by 8, as the UNet downsampling needs."
+        ),
+    )
     parser.add_argument(
         "--train_batch_size", type=int, default=16, help="Batch size (per device) for the training dataloader."
     )
@@ -357,9 +504,8 @@ def parse_args():
         type=int,
         default=None,
         help=(
-            "Max number of checkpoints to store. Passed as `total_limit` to the `Accelerator` `ProjectConfiguration`."
-            " See Accelerator::save_state https://huggingface.co/docs/accelerate/package_reference/accelerator#accelerate.Accelerator.save_state"
-            " for more docs"
+            "Max number of checkpoints to store. The oldest `checkpoint-<step>` folders in `output_dir` are deleted"
+            " once a newer checkpoint is written."
         ),
     )
     parser.add_argument(
@@ -381,6 +527,25 @@ def parse_args():
         default=5,
         help="Run validation every X epochs.",
     )
+    parser.add_argument(
+        "--async_validation",
+        action="store_true",
+        help=(
+            "Run validation on a background thread with a copy of the UNet weights, so training continues while the"
+            " validation images are generated. Needs memory for a second UNet in the mixed precision dtype."
+        ),
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help=(
+            "Record a torch profiler trace from global step START up to END and save it as a Chrome trace in"
+            " `output_dir`. Also works on CPU."
+        ),
+    )
     parser.add_argument(
         "--tracker_project_name",
         type=str,
@@ -397,8 +562,19 @@ def parse_args():
         args.local_rank = env_local_rank
 
     # Sanity checks
-    if args.dataset_name is None and args.train_data_dir is None:
-        raise ValueError("Need either a dataset name or a training folder.")
+    if (args.precompute_latents or args.use_latent_cache) and args.latent_cache_dir is None:
+        raise ValueError("`--precompute_latents` and `--use_latent_cache` need a `--latent_cache_dir`.")
+    if args.precompute_latents and args.use_latent_cache:
+        raise ValueError("Build the cache with `--precompute_latents` first, then train with `--use_latent_cache`.")
+    if args.native_resolution and (args.precompute_latents or args.use_latent_cache):
+        raise ValueError("The latent cache only stores square crops and cannot be used with `--native_resolution`.")
+    if (
+        args.dataset_name is None
+        and args.train_data_dir is None
+        and args.shard_dir is None
+        and not args.use_latent_cache
+    ):
+        raise ValueError("Need either a dataset name, a training folder, a shard folder or a latent cache.")
 
     # default to using the same revision for the non-ema model if not specified
     if args.non_ema_revision is None:
@@ -469,13 +645,19 @@ def main():
     text_encoder = CLIPTextModel.from_pretrained(
         args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision
     )
-    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision)
+    if args.use_latent_cache:
+        vae = None
+    else:
+        vae = AutoencoderKL.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision
+        )
     unet = UNet2DConditionModel.from_pretrained(
         args.pretrained_model_name_or_path, subfolder="unet", revision=args.non_ema_revision
     )
 
     # Freeze vae and text_encoder
-    vae.requires_grad_(False)
+    if vae is not None:
+        vae.requires_grad_(False)
     text_encoder.requires_grad_(False)
 
     # Create EMA for the unet.
@@ -595,7 +777,13 @@ def main():
 
     # In distributed training, the load_dataset function guarantees that only one local process can concurrently
     # download the dataset.
-    if args.dataset_name is not None:
+    if args.use_latent_cache:
+        # Pre-encoded latents, see latent_cache.py
+        dataset = None
+    elif args.shard_dir is not None:
+        # Memory-mapped spectrogram shards, see spectrogram_shards.py
+        dataset = None
+    elif args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         dataset = load_dataset(
             args.dataset_name,
@@ -615,28 +803,31 @@ def main():
         # See more about loading custom images at
         # https://huggingface.co/docs/datasets/v2.4.0/en/image_load#imagefolder
 
-    # Preprocessing the datasets.
-    # We need to tokenize inputs and targets.
-    column_names = dataset["train"].column_names
-
-    # 6. Get the column names for input/target.
-    dataset_columns = DATASET_NAME_MAPPING.get(args.dataset_name, None)
-    if args.image_column is None:
-        image_column = dataset_columns[0] if dataset_columns is not None else column_names[0]
-    else:
-        image_column = args.image_column
-        if image_column not in column_names:
-            raise ValueError(
-                f"--image_column' value '{args.image_column}' needs to be one of: {', '.join(column_names)}"
-            )
-    if args.caption_column is None:
-        caption_column = dataset_columns[1] if dataset_columns is not None else column_names[1]
+    if dataset is None:
+        image_column, caption_column = "image", "caption"
     else:
-        caption_column = args.caption_column
-        if caption_column not in column_names:
-            raise ValueError(
-                f"--caption_column' value '{args.caption_column}' needs to be one of: {', '.join(column_names)}"
-            )
+        # Preprocessing the datasets.
+        # We need to tokenize inputs and targets.
+        column_names = dataset["train"].column_names
+
+        # 6. Get the column names for input/target.
+        dataset_columns = DATASET_NAME_MAPPING.get(args.dataset_name, None)
+        if args.image_column is None:
+            image_column = dataset_columns[0] if dataset_columns is not None else column_names[0]
+        else:
+            image_column = args.image_column
+            if image_column not in column_names:
+                raise ValueError(
+                    f"--image_column' value '{args.image_column}' needs to be one of: {', '.join(column_names)}"
+                )
+        if args.caption_column is None:
+            caption_column = dataset_columns[1] if dataset_columns is not None else column_names[1]
+        else:
+            caption_column = args.caption_column
+            if caption_column not in column_names:
+                raise ValueError(
+                    f"--caption_column' value '{args.caption_column}' needs to be one of: {', '.join(column_names)}"
+                )
 
     # Preprocessing the datasets.
     # We need to tokenize input captions and transform the images.
@@ -659,42 +850,174 @@ def main():
         return inputs.input_ids
 
     # Preprocessing the datasets.
-    train_transforms = transforms.Compose(
-        [
-            transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
-            transforms.CenterCrop(args.resolution) if args.center_crop else transforms.RandomCrop(args.resolution),
-            transforms.RandomHorizontalFlip() if args.random_flip else transforms.Lambda(lambda x: x),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
-        ]
-    )
+    # The latent cache stores one fixed crop per image, and its flipped variant is encoded separately
+    center_crop = args.center_crop or args.precompute_latents
+    random_flip = args.random_flip and not args.precompute_latents
+    if args.native_resolution:
+        # No resizing or cropping; BucketBatchSampler groups images that pad to the same shape
+        train_transforms = transforms.Compose(
+            [
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5]),
+                transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
+                transforms.Lambda(lambda x: pad_to_bucket(x, args.bucket_multiple)),
+            ]
+        )
+    else:
+        train_transforms = transforms.Compose(
+            [
+                transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
+                transforms.CenterCrop(args.resolution) if center_crop else transforms.RandomCrop(args.resolution),
+                transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5]),
+            ]
+        )
+
+    # Maps each distinct caption to the row of its cached text embedding, see --max_cached_captions
+    caption_lookup = None
 
     def preprocess_train(examples):
         images = [image.convert("RGB") for image in examples[image_column]]
         examples["pixel_values"] = [train_transforms(image) for image in images]
-        examples["input_ids"] = tokenize_captions(examples)
+        if caption_lookup is not None:
+            examples["caption_index"] = [caption_lookup[caption] for caption in examples[caption_column]]
+        else:
+            examples["input_ids"] = tokenize_captions(examples)
         return examples
 
+    def preprocess_shard_example(example):
+        pixel_values = train_transforms(example["image"].convert("RGB"))
+        if caption_lookup is not None:
+            return {"pixel_values": pixel_values, "caption_index": caption_lookup[example["caption_id"]]}
+        if "input_ids" not in example:
+            example["input_ids"] = tokenize_captions({caption_column: [example["caption"]]})[0]
+        return {"pixel_values": pixel_values, "input_ids": example["input_ids"]}
+
     with accelerator.main_process_first():
-        if args.max_train_samples is not None:
-            dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
-        # Set the training transforms
-        train_dataset = dataset["train"].with_transform(preprocess_train)
+        if args.use_latent_cache:
+            cache_meta = load_latent_cache_meta(args.latent_cache_dir)
+            if cache_meta["resolution"] != args.resolution:
+                raise ValueError(
+                    f"The latent cache was built at resolution {cache_meta['resolution']}, not {args.resolution}."
+                )
+            if cache_meta["model"] != args.pretrained_model_name_or_path:
+                logger.warning(f"The latent cache was encoded with the VAE of {cache_meta['model']}.")
+            train_dataset = LatentCacheDataset(args.latent_cache_dir)
+        elif dataset is None:
+            train_dataset = ShardedSpectrogramDataset(args.shard_dir, transforms=preprocess_shard_example)
+        if dataset is None:
+            caption_source = train_dataset
+            if args.max_train_samples is not None:
+                indices = np.random.default_rng(args.seed).permutation(len(train_dataset))[: args.max_train_samples]
+                train_dataset = torch.utils.data.Subset(train_dataset, indices.tolist())
+        else:
+            if args.max_train_samples is not None:
+                dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
+            # Set the training transforms
+            train_dataset = dataset["train"].with_transform(preprocess_train)
+
+    # create_csv gives all spectrograms of a label the same caption, so the dataset usually has only a handful of
+    # distinct captions. Their embeddings are computed once and every sample only carries the index of its caption
+    caption_input_ids = None
+    if args.max_cached_captions > 0 and not args.precompute_latents:
+        if args.use_latent_cache:
+            # the latent cache only stores token ids, so distinct rows of token ids stand in for the captions
+            unique_ids = np.unique(caption_source.input_ids, axis=0)
+            caption_lookup = {row.tobytes(): i for i, row in enumerate(unique_ids)}
+            caption_input_ids = torch.from_numpy(unique_ids)
+        elif dataset is None:
+            # shard samples carry the id of their caption in the shard index, so the lookup is keyed by that id
+            caption_ids = np.unique(caption_source.caption_ids()).tolist()
+            caption_lookup = {caption_id: i for i, caption_id in enumerate(caption_ids)}
+            captions = [caption_source.captions[caption_id] for caption_id in caption_ids]
+            caption_input_ids = tokenize_captions({caption_column: captions})
+        else:
+            captions = dataset["train"].unique(caption_column)
+            if all(isinstance(caption, str) for caption in captions):
+                caption_lookup = {caption: i for i, caption in enumerate(captions)}
+                caption_input_ids = tokenize_captions({caption_column: captions})
+        if caption_lookup is not None and len(caption_lookup) > args.max_cached_captions:
+            logger.info(f"Found {len(caption_lookup)} distinct captions, encoding the captions every step instead.")
+            caption_lookup, caption_input_ids = None, None
+
+    def caption_index(example):
+        if "caption_index" in example:
+            return example["caption_index"]
+        return caption_lookup[example["input_ids"].numpy().tobytes()]
 
     def collate_fn(examples):
+        if caption_lookup is not None:
+            text = {"caption_index": torch.tensor([caption_index(example) for example in examples], dtype=torch.long)}
+        else:
+            text = {"input_ids": torch.stack([example["input_ids"] for example in examples])}
+        if args.use_latent_cache:
+            latent_parameters = torch.stack([example["latent_parameters"] for example in examples])
+            return {"latent_parameters": latent_parameters, **text}
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
         pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-        input_ids = torch.stack([example["input_ids"] for example in examples])
-        return {"pixel_values": pixel_values, "input_ids": input_ids}
+        return {"pixel_values": pixel_values, **text}
+
+    if args.precompute_latents:
+        # Encodes the training set once in full precision and stops; train with `--use_latent_cache` afterwards
+        if accelerator.is_main_process:
+            vae.to(accelerator.device)
+            cache_dataloader = torch.utils.data.DataLoader(
+                train_dataset,
+                shuffle=False,
+                collate_fn=collate_fn,
+                batch_size=args.train_batch_size,
+                num_workers=args.dataloader_num_workers,
+            )
+            build_latent_cache(
+                vae,
+                cache_dataloader,
+                args.latent_cache_dir,
+                len(train_dataset),
+                args.resolution,
+                flip=args.random_flip,
+                model_name=args.pretrained_model_name_or_path,
+                device=accelerator.device,
+            )
+            logger.info(f"Saved the latent cache to {args.latent_cache_dir}")
+        accelerator.wait_for_everyone()
+        accelerator.end_training()
+        return
 
     # DataLoaders creation:
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        shuffle=True,
-        collate_fn=collate_fn,
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
-    )
+    if args.native_resolution:
+        # Reads the image sizes from the shard index or the image headers, without decoding any pixels
+        if dataset is None:
+            sizes = caption_source.image_sizes()
+            if isinstance(train_dataset, torch.utils.data.Subset):
+                sizes = sizes[train_dataset.indices]
+        else:
+            undecoded = dataset["train"].cast_column(image_column, datasets.Image(decode=False))
+            sizes = []
+            for item in undecoded[image_column]:
+                with Image.open(io.BytesIO(item["bytes"]) if item["bytes"] else item["path"]) as image:
+                    sizes.append((image.height, image.width))
+        batch_sampler = BucketBatchSampler(
+            [bucket_shape(size, args.bucket_multiple) for size in sizes],
+            args.train_batch_size,
+            seed=args.seed if args.seed is not None else 0,
+            num_replicas=accelerator.num_processes,
+        )
+        logger.info(f"  Buckets (height, width): samples = {batch_sampler.bucket_sizes()}")
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn,
+            num_workers=args.dataloader_num_workers,
+        )
+    else:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            shuffle=True,
+            collate_fn=collate_fn,
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+        )
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
@@ -728,7 +1051,23 @@ def main():
 
     # Move text_encode and vae to gpu and cast to weight_dtype
     text_encoder.to(accelerator.device, dtype=weight_dtype)
-    vae.to(accelerator.device, dtype=weight_dtype)
+    if vae is not None:
+        vae.to(accelerator.device, dtype=weight_dtype)
+
+    # The validation prompts and the empty prompt are encoded while the text encoder is still on the GPU
+    validation_embeddings = None
+    if accelerator.is_main_process and args.validation_prompts is not None:
+        validation_embeddings = encode_prompts(
+            text_encoder, tokenizer, list(args.validation_prompts) + [""], accelerator.device
+        )
+
+    caption_embeddings = None
+    if caption_lookup is not None:
+        with torch.no_grad():
+            caption_embeddings = text_encoder(caption_input_ids.to(accelerator.device))[0]
+        # The text encoder is not called again, the validation pipeline only holds it
+        text_encoder.to("cpu")
+        logger.info(f"Cached the text embeddings of {len(caption_lookup)} distinct captions")
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -742,8 +1081,40 @@ def main():
     if accelerator.is_main_process:
         tracker_config = dict(vars(args))
         tracker_config.pop("validation_prompts")
+        # tensorboard's add_hparams only takes scalars and strings
+        if args.profile_steps is not None:
+            tracker_config["profile_steps"] = "{}-{}".format(*args.profile_steps)
+        else:
+            tracker_config.pop("profile_steps")
         accelerator.init_trackers(args.tracker_project_name, tracker_config)
 
+    # Built once and reused by every validation run
+    validation = None
+    if accelerator.is_main_process and args.validation_prompts is not None:
+        height = width = None
+        if args.native_resolution:
+            # Generates at the padded shape shared by most training spectrograms
+            bucket_sizes = batch_sampler.bucket_sizes()
+            height, width = max(bucket_sizes, key=bucket_sizes.get)
+        validation = ValidationHarness(
+            args,
+            accelerator,
+            vae,
+            text_encoder,
+            tokenizer,
+            unet,
+            weight_dtype,
+            validation_embeddings,
+            height=height,
+            width=width,
+            run_async=args.async_validation,
+        )
+
+    # Checkpoints are snapshotted to host memory and written by a background thread, see checkpoint_writer.py
+    checkpoint_writer = None
+    if accelerator.is_main_process:
+        checkpoint_writer = AsyncCheckpointWriter(args.output_dir, total_limit=args.checkpoints_total_limit)
+
     # Train!
     total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
 
@@ -786,20 +1157,34 @@ def main():
     progress_bar = tqdm(range(global_step, args.max_train_steps), disable=not accelerator.is_local_main_process)
     progress_bar.set_description("Steps")
 
+    # Time spent in every phase of the step, logged with the loss, see step_timer.py
+    timer = StepTimer(accelerator.device)
+    profiler = None
+    if args.profile_steps is not None and accelerator.is_main_process:
+        profiler = ProfilerWindow(*args.profile_steps, args.output_dir, timer=timer)
+
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
         train_loss = 0.0
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(timer.iterate(train_dataloader)):
             # Skip steps until we reach the resumed step
             if args.resume_from_checkpoint and epoch == first_epoch and step < resume_step:
                 if step % args.gradient_accumulation_steps == 0:
                     progress_bar.update(1)
                 continue
 
+            if profiler is not None:
+                profiler.step(global_step)
+
             with accelerator.accumulate(unet):
                 # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(weight_dtype)).latent_dist.sample()
-                latents = latents * vae.config.scaling_factor
+                with timer.span("vae"):
+                    if args.use_latent_cache:
+                        latent_parameters = batch["latent_parameters"].to(weight_dtype)
+                        latents = sample_latents(latent_parameters, cache_meta["scaling_factor"])
+                    else:
+                        latents = vae.encode(batch["pixel_values"].to(weight_dtype)).latent_dist.sample()
+                        latents = latents * vae.config.scaling_factor
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
@@ -819,7 +1204,11 @@ def main():
                 noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
                 # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(batch["input_ids"])[0]
+                with timer.span("text_encoder"):
+                    if caption_embeddings is not None:
+                        encoder_hidden_states = caption_embeddings[batch["caption_index"]]
+                    else:
+                        encoder_hidden_states = text_encoder(batch["input_ids"])[0]
 
                 # Get the target for loss depending on the prediction type
                 if noise_scheduler.config.prediction_type == "epsilon":
@@ -830,51 +1219,62 @@ def main():
                     raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
 
                 # Predict the noise residual and compute loss
-                model_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
-
-                if args.snr_gamma is None:
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
-                else:
-                    # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
-                    # Since we predict the noise instead of x_0, the original formulation is slightly changed.
-                    # This is discussed in Section 4.2 of the same paper.
-                    snr = compute_snr(timesteps)
-                    mse_loss_weights = (
-                        torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
-                    )
-                    # We first calculate the original loss. Then we mean over the non-batch dimensions and
-                    # rebalance the sample-wise losses with their respective loss weights.
-                    # Finally, we take the mean of the rebalanced loss.
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
-                    loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
-                    loss = loss.mean()
+                with timer.span("unet_forward"):
+                    model_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
+
+                    if args.snr_gamma is None:
+                        loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                    else:
+                        # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
+                        # Since we predict the noise instead of x_0, the original formulation is slightly changed.
+                        # This is discussed in Section 4.2 of the same paper.
+                        snr = compute_snr(timesteps)
+                        mse_loss_weights = (
+                            torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
+                        )
+                        # We first calculate the original loss. Then we mean over the non-batch dimensions and
+                        # rebalance the sample-wise losses with their respective loss weights.
+                        # Finally, we take the mean of the rebalanced loss.
+                        loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+                        loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
+                        loss = loss.mean()
 
                 # Gather the losses across all processes for logging (if we use distributed training).
                 avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
                 train_loss += avg_loss.item() / args.gradient_accumulation_steps
 
                 # Backpropagate
-                accelerator.backward(loss)
-                if accelerator.sync_gradients:
-                    accelerator.clip_grad_norm_(unet.parameters(), args.max_grad_norm)
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                with timer.span("unet_backward"):
+                    accelerator.backward(loss)
+                with timer.span("optimizer"):
+                    if accelerator.sync_gradients:
+                        accelerator.clip_grad_norm_(unet.parameters(), args.max_grad_norm)
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad()
+            timer.add_samples(bsz * accelerator.num_processes)
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 if args.use_ema:
-                    ema_unet.step(unet.parameters())
+                    with timer.span("ema"):
+                        ema_unet.step(unet.parameters())
                 progress_bar.update(1)
                 global_step += 1
-                accelerator.log({"train_loss": train_loss}, step=global_step)
+                accelerator.log({"train_loss": train_loss, **timer.summary()}, step=global_step)
                 train_loss = 0.0
 
                 if global_step % args.checkpointing_steps == 0:
                     if accelerator.is_main_process:
                         save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
-                        accelerator.save_state(save_path)
-                        logger.info(f"Saved state to {save_path}")
+                        with timer.span("checkpoint"):
+                            checkpoint_writer.save(
+                                save_path,
+                                accelerate_checkpoint_files(
+                                    accelerator, unet, optimizer, lr_scheduler, ema_unet if args.use_ema else None
+                                ),
+                            )
+                        logger.info(f"Writing state to {save_path} in the background")
 
             logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
@@ -888,20 +1288,19 @@ def main():
                     # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
                     ema_unet.store(unet.parameters())
                     ema_unet.copy_to(unet.parameters())
-                log_validation(
-                    vae,
-                    text_encoder,
-                    tokenizer,
-                    unet,
-                    args,
-                    accelerator,
-                    weight_dtype,
-                    global_step,
-                )
+                with timer.span("validation"):
+                    validation.run(global_step)
                 if args.use_ema:
                     # Switch back to the original UNet parameters.
                     ema_unet.restore(unet.parameters())
 
+    if profiler is not None:
+        profiler.stop()
+    if validation is not None:
+        validation.wait()
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+
     # Create the pipeline using the trained modules and save it.
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -909,12 +1308,13 @@ def main():
         if args.use_ema:
             ema_unet.copy_to(unet.parameters())
 
+        pipeline_kwargs = {} if vae is None else {"vae": vae}
         pipeline = StableDiffusionPipeline.from_pretrained(
             args.pretrained_model_name_or_path,
             text_encoder=text_encoder,
-            vae=vae,
             unet=unet,
             revision=args.revision,
+            **pipeline_kwargs,
         )
         pipeline.save_pretrained(args.output_dir)
 
@@ -3,16 +3,177 @@
 # COMS 4995 - Final Project
 # NOTE: The system is used by running youtube_scraper.py
 import os
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import queue
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import youtube_dl
 from google.cloud import storage
 from googleapiclient.discovery import build
+from music_processor import (segment_windows, process_file, processing_params, source_entry, entry_is_current,
+                             load_manifest, save_manifest, remove_outputs, report_throughput, create_csv,
+                             count_segments)
 
 
-# Takes search keyword and YouTube API key, searches for YouTube videos using keyword and calls scrape_youtube
-# to download each audio file
-def search_and_download(keyword, api_key):
+# Uploads audio files to the GCP storage bucket; one client and bucket handle are shared by every upload
+class GCSStorage:
+    def __init__(self, bucket_name='music_data_4995', client=None):
+        self.client = client if client is not None else storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def upload(self, local_path, blob_name):
+        self.bucket.blob(blob_name).upload_from_filename(local_path)
+
+    def exists(self, blob_name):
+        return self.bucket.blob(blob_name).exists()
+
+
+# Stand-in for GCSStorage that copies the files into a local folder, e.g. for tests or offline runs
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, local_path, blob_name):
+        path = os.path.join(self.root, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path)
+
+    def exists(self, blob_name):
+        return os.path.exists(os.path.join(self.root, blob_name))
+
+
+# Storage backend that turns every track into spectrograms as soon as it is downloaded, so scraping, segmenting
+# and mel conversion overlap instead of running as separate passes over the whole collection
+# Tracks are kept in the same label folders transform_music reads (root/<keyword>/) and converted by a process
+# pool; the music_processor build manifest is updated after every track, so a later transform_music run with the
+# same streaming and store settings skips them
+class SpectrogramStorage(LocalStorage):
+    def __init__(self, root='.', num_workers=1, streaming=False, store='jpeg', manifest_path='data/manifest.json'):
+        super().__init__(root)
+        self.convert = functools.partial(process_file, streaming=streaming, store=store)
+        self.params = processing_params(streaming=streaming, store=store)
+        self.manifest_path = manifest_path
+        self.entries = load_manifest(manifest_path)
+        self.lock = threading.Lock()
+        self.number_files = 0
+        self.number_segments = 0
+        self.first_output = None
+        os.makedirs('data/train', exist_ok=True)
+        os.makedirs('data/test', exist_ok=True)
+        # the upload threads are already running when the first worker starts, so workers are spawned, not forked
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+        self.start = time.perf_counter()
+
+    def upload(self, local_path, blob_name):
+        super().upload(local_path, blob_name)
+        file_path = os.path.normpath(os.path.join(self.root, blob_name))
+        source = source_entry(file_path, None)
+        source["params"] = self.params
+        with self.lock:
+            stale = self.entries.pop(file_path, None)
+        if stale is not None:
+            remove_outputs(stale["outputs"])
+
+        outputs = self.executor.submit(self.convert, file_path, os.path.dirname(blob_name)).result()
+
+        with self.lock:
+            if self.first_output is None:
+                self.first_output = time.perf_counter() - self.start
+                print("First spectrogram ready after {:.1f}s".format(self.first_output))
+            self.entries[file_path] = dict(source, outputs=outputs)
+            self.number_files += 1
+            self.number_segments += count_segments(outputs)
+            save_manifest(self.manifest_path, self.entries)
+
+    # A track only counts as stored once its spectrograms are built from it with the current parameters
+    def exists(self, blob_name):
+        file_path = os.path.normpath(os.path.join(self.root, blob_name))
+        if not os.path.exists(file_path):
+            return False
+        with self.lock:
+            entry = self.entries.get(file_path)
+        source = source_entry(file_path, entry)
+        source["params"] = self.params
+        return entry_is_current(entry, source)
+
+    # Waits for the process pool and prints the conversion throughput
+    def close(self):
+        self.executor.shutdown()
+        report_throughput(self.number_files, self.number_segments, time.perf_counter() - self.start)
+
+
+# Persistent record of the videos found for every keyword and how far each one got
+# (searched, downloaded, uploaded or failed), so an interrupted run resumes where it stopped
+class ScrapeManifest:
+    def __init__(self, path='scrape_manifest.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.keywords = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.keywords = json.load(f)
+
+    def has_search(self, keyword):
+        return keyword in self.keywords
+
+    # Stores the search results of a keyword, keeping the status of videos that were seen before
+    def record_search(self, keyword, video_ids):
+        with self.lock:
+            videos = self.keywords.setdefault(keyword, {})
+            for video_id in video_ids:
+                videos.setdefault(video_id, {"status": "searched", "attempts": 0})
+            self.save()
+
+    def set_status(self, keyword, video_id, status, error=None):
+        with self.lock:
+            video = self.keywords.setdefault(keyword, {}).setdefault(video_id, {"status": "searched", "attempts": 0})
+            video["status"] = status
+            if status == "failed":
+                video["attempts"] += 1
+                video["error"] = error
+            else:
+                video.pop("error", None)
+            self.save()
+
+    # Returns the (video_id, keyword) jobs that are not uploaded yet and have failed fewer than max_attempts runs
+    def pending_jobs(self, keywords, max_attempts=5):
+        jobs = []
+        for keyword in keywords:
+            for video_id, video in self.keywords.get(keyword, {}).items():
+                if video["status"] == "uploaded":
+                    continue
+                if video["attempts"] >= max_attempts:
+                    print(f"Giving up on video {video_id} after {video['attempts']} failed runs")
+                    continue
+                jobs.append((video_id, keyword))
+        return jobs
+
+    # Writes through a temporary file so a crash never leaves a half written manifest
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.keywords, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+# Default manifest of a storage backend and audio format, so a video stored by one kind of run is still pending for
+# the others; bucket runs with mp3 keep the original scrape_manifest.json
+def manifest_path(backend_name, audio_format):
+    if backend_name == 'gcs' and audio_format == 'mp3':
+        return 'scrape_manifest.json'
+    return f'scrape_manifest_{backend_name}_{audio_format}.json'
+
+
+# Takes search keyword and YouTube API key and returns the IDs of the first 2 pages of video search results
+def search_videos(keyword, api_key):
     # Setting up the YouTube API client
     youtube = build('youtube', 'v3', developerKey=api_key)
 
@@ -31,39 +192,200 @@ def search_and_download(keyword, api_key):
     for item in response['items']:
         video_id = item['id']['videoId']
         video_ids.append(video_id)
+    return video_ids[:20]
 
-    # Downloads audio from the first 2 pages of video search results
-    for video_id in video_ids[:20]:
-        try:
-            scrape_youtube(video_id, keyword)
-        except youtube_dl.utils.DownloadError as e:
-            print(f"Error downloading video {video_id}: {e}")
+
+# Takes search keyword and YouTube API key, searches for YouTube videos using keyword and downloads the audio
+# of each video through the download/upload pipeline
+def search_and_download(keyword, api_key, storage_backend=None, download_workers=4, upload_workers=2, manifest=None,
+                        audio_format='mp3', trim=False):
+    if storage_backend is None:
+        storage_backend = GCSStorage()
+    if manifest is None:
+        jobs = [(video_id, keyword) for video_id in search_videos(keyword, api_key)]
+    else:
+        if not manifest.has_search(keyword):
+            manifest.record_search(keyword, search_videos(keyword, api_key))
+        jobs = manifest.pending_jobs([keyword])
+    return run_pipeline(jobs, storage_backend, download_workers=download_workers, upload_workers=upload_workers,
+                        manifest=manifest, audio_format=audio_format, trim=trim)
 
 
 # Takes the video ID and search keyword, downloads the audio from the YouTube video and saves to GCP bucket
-def scrape_youtube(video_id, keyword):
-    youtube_root = 'https://www.youtube.com/watch?v='
-    bucket_name = 'music_data_4995'
+def scrape_youtube(video_id, keyword, storage_backend=None, audio_format='mp3', trim=False):
+    if storage_backend is None:
+        storage_backend = GCSStorage()
+    if storage_backend.exists(blob_name(keyword, audio_file_name(video_id, audio_format))):
+        return
+    temp_file = download_audio(video_id, audio_format, trim)
+    try:
+        storage_backend.upload(temp_file, blob_name(keyword, temp_file))
+    finally:
+        remove_download(temp_file)
 
-    # Downloads the audio from the YouTube video to a temporary file
+
+# Name of the audio file saved for a video
+def audio_file_name(video_id, audio_format='mp3'):
+    return video_id + '.' + audio_format
+
+
+# Downloads the audio from the YouTube video to a temporary file and returns its path
+# audio_format='mp3' transcodes through ffmpeg like before. audio_format='flac' fetches the native audio stream
+# and stores it once as mono 22050 Hz FLAC, the format music_processor analyses, so there is no lossy transcode
+# and no resampling when the spectrograms are built. trim=True keeps only the 15 second windows music_processor
+# uses (see trim_filter)
+def download_audio(video_id, audio_format='mp3', trim=False):
+    youtube_root = 'https://www.youtube.com/watch?v='
     youtube_url = youtube_root + video_id
     temp_dir = tempfile.mkdtemp()
-    file_name = video_id + '.mp3'
+    file_name = audio_file_name(video_id, audio_format)
     temp_file = os.path.join(temp_dir, file_name)
-    subprocess.call(
-        ['yt-dlp', '--no-warnings', '--extract-audio', '--audio-format', 'mp3', '--audio-quality', '0', '--verbose',
-         '-o', temp_file, youtube_url])
+    if audio_format == 'mp3':
+        code = subprocess.call(
+            ['yt-dlp', '--no-warnings', '--extract-audio', '--audio-format', 'mp3', '--audio-quality', '0',
+             '--verbose', '-o', temp_file, youtube_url])
+    else:
+        native_file = os.path.join(temp_dir, video_id + '.native')
+        code = subprocess.call(['yt-dlp', '--no-warnings', '-f', 'bestaudio', '-o', native_file, youtube_url])
+        if code == 0 and os.path.exists(native_file):
+            code = convert_native_audio(native_file, temp_file, trim)
+            os.remove(native_file)
+    if code != 0 or not os.path.exists(temp_file):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise youtube_dl.utils.DownloadError("yt-dlp exited with code " + str(code) + " for " + video_id)
+    return temp_file
+
+
+# Decodes the native audio stream once into mono 22050 Hz FLAC, optionally trimmed to the analysed windows
+def convert_native_audio(native_file, output_file, trim=False, sr=22050):
+    command = ['ffmpeg', '-v', 'error', '-y', '-i', native_file]
+    if trim:
+        filter_graph = trim_filter(probe_duration(native_file), sr)
+        if filter_graph is not None:
+            command += ['-filter_complex', filter_graph, '-map', '[out]']
+    command += ['-ac', '1', '-ar', str(sr), '-c:a', 'flac', output_file]
+    return subprocess.call(command)
+
 
-    # Uploads the audio file to the GCP storage bucket
+# Returns the duration of an audio file in seconds
+def probe_duration(file_path):
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
+                                      'default=noprint_wrappers=1:nokey=1', file_path])
+    return float(output.decode().strip())
+
+
+# Builds an ffmpeg filter graph that keeps only the 15 second windows music_processor.process_file picks and
+# concatenates them. The trimmed file is exactly 15 windows long, so process_file picks the same windows from it
+# again. Tracks of 15 windows or less are used whole by process_file, so they are not trimmed (returns None)
+def trim_filter(duration, sr=22050, segment_seconds=15):
+    segment_length = sr * segment_seconds
+    number_sections = math.ceil(duration * sr / segment_length)
+    if number_sections <= 15:
+        return None
+
+    windows = segment_windows(number_sections)
+    parts = ['[0:a]aformat=channel_layouts=mono,aresample={},asplit={}{}'.format(
+        sr, len(windows), ''.join('[s{}]'.format(i) for i in range(len(windows))))]
+    for i, section in enumerate(windows):
+        parts.append('[s{0}]atrim=start_sample={1}:end_sample={2},asetpts=PTS-STARTPTS[t{0}]'.format(
+            i, section * segment_length, (section + 1) * segment_length))
+    parts.append('{}concat=n={}:v=0:a=1[out]'.format(
+        ''.join('[t{}]'.format(i) for i in range(len(windows))), len(windows)))
+    return ';'.join(parts)
+
+
+# Name of the uploaded file in the bucket, one folder per keyword
+def blob_name(keyword, file_path):
     folder_name = keyword.replace(' ', '_')
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(f"{folder_name}/{file_name}")
-    blob.upload_from_filename(temp_file)
+    return f"{folder_name}/{os.path.basename(file_path)}"
+
+
+# Cleans up the temporary directory of a download
+def remove_download(temp_file):
+    shutil.rmtree(os.path.dirname(temp_file), ignore_errors=True)
 
-    # Cleans up temporary directory
-    os.remove(temp_file)
-    os.rmdir(temp_dir)
+
+# Calls fn until it succeeds, sleeping backoff, 2 * backoff, 4 * backoff, ... seconds between the attempts
+def with_retries(fn, retries=2, backoff=5.0):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+# Downloads and uploads the (video_id, keyword) jobs concurrently
+# At most download_workers yt-dlp processes run at a time. Finished downloads wait in a queue of queue_size for
+# the upload_workers threads, which share one storage backend; when uploads fall behind, the queue fills up and
+# the download threads block instead of piling up temporary files
+# With a manifest, videos whose file already exists in the storage backend are not downloaded again and every
+# status change is recorded; failed downloads and uploads are retried with exponential backoff
+def run_pipeline(jobs, storage_backend, download_workers=4, upload_workers=2, queue_size=4, manifest=None,
+                 retries=2, backoff=5.0, audio_format='mp3', trim=False):
+    uploads = queue.Queue(maxsize=queue_size)
+    stats = {"downloaded": 0, "uploaded": 0, "skipped": 0, "failed": 0}
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def count(key):
+        with lock:
+            stats[key] += 1
+
+    def record(keyword, video_id, status, error=None):
+        if manifest is not None:
+            manifest.set_status(keyword, video_id, status, error)
+
+    def download(job):
+        video_id, keyword = job
+        try:
+            if storage_backend.exists(blob_name(keyword, audio_file_name(video_id, audio_format))):
+                record(keyword, video_id, "uploaded")
+                count("skipped")
+                return
+            temp_file = with_retries(lambda: download_audio(video_id, audio_format, trim), retries, backoff)
+        except Exception as e:
+            print(f"Error downloading video {video_id}: {e}")
+            record(keyword, video_id, "failed", str(e))
+            count("failed")
+            return
+        record(keyword, video_id, "downloaded")
+        count("downloaded")
+        uploads.put((video_id, keyword, temp_file))
+
+    def upload():
+        while True:
+            item = uploads.get()
+            if item is None:
+                return
+            video_id, keyword, temp_file = item
+            try:
+                with_retries(lambda: storage_backend.upload(temp_file, blob_name(keyword, temp_file)), retries,
+                             backoff)
+                record(keyword, video_id, "uploaded")
+                count("uploaded")
+            except Exception as e:
+                print(f"Error uploading video {video_id}: {e}")
+                record(keyword, video_id, "failed", str(e))
+                count("failed")
+            finally:
+                remove_download(temp_file)
+
+    uploaders = [threading.Thread(target=upload, daemon=True) for _ in range(max(upload_workers, 1))]
+    for uploader in uploaders:
+        uploader.start()
+    with ThreadPoolExecutor(max_workers=max(download_workers, 1)) as executor:
+        list(executor.map(download, jobs))
+    for _ in uploaders:
+        uploads.put(None)
+    for uploader in uploaders:
+        uploader.join()
+
+    elapsed = time.perf_counter() - start
+    print("Downloaded {downloaded}, uploaded {uploaded}, skipped {skipped}, failed {failed}".format(**stats)
+          + " in {:.1f}s".format(elapsed))
+    return stats
 
 
 # Runs when youtube_scraper.py is run
@@ -74,6 +396,58 @@ if __name__ == "__main__":
                 'calm music', 'peaceful music', 'relaxing music',
                 'classical music', 'classic music']
 
-    # Replace "API_KEY" with actual key
+    parser = argparse.ArgumentParser(description="Downloads the audio of YouTube search results for each keyword.")
+    parser.add_argument("--api_key", type=str, default="API_KEY", help="YouTube Data API key.")
+    parser.add_argument("--download_workers", type=int, default=4, help="Number of concurrent yt-dlp processes.")
+    parser.add_argument("--upload_workers", type=int, default=2, help="Number of concurrent uploads.")
+    parser.add_argument("--local_dir", type=str, default=None,
+                        help="Save the audio files into this folder instead of the GCP bucket.")
+    parser.add_argument("--audio_format", choices=["mp3", "flac"], default="mp3",
+                        help="mp3 transcodes like before; flac stores the native stream as mono 22050 Hz FLAC.")
+    parser.add_argument("--trim_segments", action="store_true",
+                        help="With flac, keep only the 15 second windows music_processor.py turns into spectrograms.")
+    parser.add_argument("--spectrograms", action="store_true",
+                        help="Save the tracks into the local label folders and turn each one into spectrograms "
+                             "as soon as it is downloaded, instead of uploading to the GCP bucket.")
+    parser.add_argument("--spectrogram_workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes building spectrograms with --spectrograms.")
+    parser.add_argument("--store", choices=["jpeg", "npy", "both"], default="jpeg",
+                        help="Spectrogram format written with --spectrograms (see music_processor.py).")
+    parser.add_argument("--streaming", action="store_true",
+                        help="With --spectrograms, decode only the kept 15 second windows. Must match the "
+                             "--streaming setting of music_processor.py, or it converts these tracks again.")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Records search results and per-video status so a restart resumes where it stopped. "
+                             "Defaults to one file per backend and audio format, e.g. "
+                             "scrape_manifest_spectrograms_flac.json.")
+    parser.add_argument("--max_attempts", type=int, default=5,
+                        help="Number of runs a failing video is retried in before it is skipped.")
+    args = parser.parse_args()
+
+    upload_workers, queue_size = args.upload_workers, 4
+    if args.spectrograms:
+        backend = SpectrogramStorage(num_workers=args.spectrogram_workers, streaming=args.streaming,
+                                     store=args.store)
+        # every upload thread waits on one conversion, so there is one thread per spectrogram worker, and the
+        # queue holds one finished download per worker so the pool never waits on yt-dlp while downloads are ahead
+        upload_workers = max(upload_workers, args.spectrogram_workers)
+        queue_size = max(queue_size, args.spectrogram_workers)
+    elif args.local_dir is not None:
+        backend = LocalStorage(args.local_dir)
+    else:
+        backend = GCSStorage()
+    if args.manifest is None:
+        backend_name = 'spectrograms' if args.spectrograms else 'local' if args.local_dir is not None else 'gcs'
+        args.manifest = manifest_path(backend_name, args.audio_format)
+    manifest = ScrapeManifest(args.manifest)
+
+    # Searches every keyword that has no stored results yet, then feeds all pending videos into one pipeline
     for keyword in keywords:
-        search_and_download(keyword, "API_KEY")
+        if not manifest.has_search(keyword):
+            manifest.record_search(keyword, search_videos(keyword, args.api_key))
+    jobs = manifest.pending_jobs(keywords, max_attempts=args.max_attempts)
+    run_pipeline(jobs, backend, download_workers=args.download_workers, upload_workers=upload_workers,
+                 queue_size=queue_size, manifest=manifest, audio_format=args.audio_format, trim=args.trim_segments)
+    if args.spectrograms:
+        backend.close()
+        create_csv(["data/train", "data/test"])